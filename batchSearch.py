@@ -0,0 +1,52 @@
+#!/usr/local/bin/python3.11
+#
+#  Answer a file of questions (one question per line) against one corpus, write answers as JSON lines.
+#
+#  usage:
+#     batchSearch.py questions.txt --webs urls.txt [--output answers.jsonl] [--top 12]
+#     batchSearch.py questions.txt --store /tmp/web-<hash>.csv
+#     batchSearch.py questions.txt --search "search phrase"
+#
+import time, sys, traceback, argparse
+from openaifuncs import get_embedded_dataframe, get_answers_batch
+from commonfuncs import log
+
+parser = argparse.ArgumentParser(description="Answer a file of questions against one corpus, as JSON lines")
+parser.add_argument("questions", help="questions file, one question per line")
+parser.add_argument("--webs", default="", help="file of web URLs to build the corpus, one URL per line")
+parser.add_argument("--store", default="", help="existing data store file, such as /tmp/web-<hash>.csv")
+parser.add_argument("--search", default="", help="search phrase to build the corpus from search results")
+parser.add_argument("--output", default="", help="output JSON lines file, default standard output")
+parser.add_argument("--top", type=int, default=12, help="number of top sections for each question")
+parser.add_argument("--workers", type=int, default=8, help="number of concurrent completion calls")
+args = parser.parse_args()
+
+# redirect error to a file
+sys.stderr = open('stderr.txt', 'w')
+
+try:
+    with open(args.questions) as qfile:
+        questions = [q.strip() for q in qfile if len(q.strip()) > 2]
+    if len(questions) == 0:
+        log(f"No questions in {args.questions}, exit!     ", endstr="\n")
+        sys.exit(0)
+    webs = []
+    if len(args.webs) > 0:
+        with open(args.webs) as wfile:
+            webs = [w.strip() for w in wfile if len(w.strip()) > 0]
+
+    df = get_embedded_dataframe(webs, searchphrase=args.search, filename=args.store)
+    if df is None or df.empty:
+        log("Failed to load data frame, exit!     ", endstr="\n")
+        sys.exit(1)
+
+    outfile = sys.stdout if len(args.output) == 0 else open(args.output, "w")
+    get_answers_batch(df, questions, top_n=args.top, outfile=outfile, num_workers=args.workers)
+    if outfile != sys.stdout:
+        outfile.close()
+
+except Exception as err:
+    log(f"Unexpected {err=}, {type(err)=}")
+    traceback.print_exc(limit=5, file=sys.stderr, chain=False)
+    time.sleep(2)
+    sys.exit(1)
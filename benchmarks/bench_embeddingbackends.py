@@ -0,0 +1,77 @@
+#!/usr/local/bin/python3.11
+#
+#  Compare embedding backends on the benchmark fixtures: ingest time, and retrieval quality of fixture questions
+#  (hit rate of the expected web page in top 1 and top 3 sections, mean reciprocal rank).
+#
+#  usage:
+#     python3 benchmarks/bench_embeddingbackends.py [--backends local,openai]
+#
+#  the openai backend needs OPENAI_API_KEY, and is skipped without it.
+#
+import os, sys, json, time, argparse, tempfile
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import openaifuncs
+from webpagedigest import parsehtmlsinglepass
+
+fixturedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture_corpus():
+    df = pd.DataFrame(None, columns=['webpage', 'subject', 'content', 'combined'])
+    pagedir = os.path.join(fixturedir, "pages")
+    for pagename in sorted(os.listdir(pagedir)):
+        with open(os.path.join(pagedir, pagename)) as pagefile:
+            df = parsehtmlsinglepass(df, pagename, pagefile.read(), openaifuncs.maxsectionlength, openaifuncs.ignorelength, openaifuncs.mincontentoverlap)
+    return df
+
+def load_fixture_questions():
+    with open(os.path.join(fixturedir, "questions.jsonl")) as qfile:
+        return [json.loads(aline) for aline in qfile if len(aline.strip()) > 0]
+
+def run_backend(backend, corpus, questions, workdir):
+    embeddingfilename = os.path.join(workdir, "bench-" + backend + ".csv")
+    ingeststart = time.perf_counter()
+    df = openaifuncs.embed_sections(corpus.copy(), embeddingfilename, backend=backend)
+    ingesttime = time.perf_counter() - ingeststart
+    df.to_csv(embeddingfilename, sep="\t")
+    df = openaifuncs.load_embedding_store(pd.read_csv(embeddingfilename, sep="\t"), embeddingfilename)
+
+    hits1 = 0
+    hits3 = 0
+    rranks = 0.0
+    topsims = []
+    querystart = time.perf_counter()
+    for aq in questions:
+        topdf = openaifuncs.search_embedding(df, aq["question"], top_n=len(df.index))
+        pages = topdf.webpage.tolist()
+        topsims.append(topdf.similarity.iloc[0])
+        if aq["webpage"] in pages:
+            rank = pages.index(aq["webpage"]) + 1
+            hits1 += rank <= 1
+            hits3 += rank <= 3
+            rranks += 1.0 / rank
+    querytime = (time.perf_counter() - querystart) * 1000 / len(questions)
+    store = openaifuncs.get_embedding_store(df)
+    numq = len(questions)
+    return [backend, store["dims"], ingesttime, querytime, hits1 / numq, hits3 / numq, rranks / numq, sum(topsims) / numq]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", default="local,openai")
+    args = parser.parse_args()
+
+    corpus = load_fixture_corpus()
+    questions = load_fixture_questions()
+    print(f"fixtures: {corpus.webpage.nunique()} pages, {len(corpus.index)} sections, {len(questions)} questions")
+    print(f"{'backend':<10}{'dims':>6}{'ingest s':>10}{'ms/query':>10}{'hit@1':>8}{'hit@3':>8}{'MRR':>8}{'top sim':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backends.split(","):
+            if backend == "openai" and len(os.environ.get("OPENAI_API_KEY", "")) == 0:
+                print(f"{backend:<10} skipped, OPENAI_API_KEY is not set")
+                continue
+            row = run_backend(backend, corpus, questions, workdir)
+            print(f"{row[0]:<10}{row[1]:>6}{row[2]:>10.2f}{row[3]:>10.2f}{row[4]:>8.2f}{row[5]:>8.2f}{row[6]:>8.3f}{row[7]:>9.3f}")
+
+if __name__ == "__main__":
+    main()
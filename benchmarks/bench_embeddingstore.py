@@ -0,0 +1,76 @@
+#!/usr/local/bin/python3.11
+#
+#  Measure memory, search latency and top-k agreement of quantized embedding stores against full precision.
+#
+#  usage:
+#     python3 benchmarks/bench_embeddingstore.py [/tmp/web-<hash>.csv] [--rows 20000] [--queries 200] [--top 12]
+#
+#  with a data store file, its embeddings are used and queries are sampled from its rows (with noise);
+#  otherwise, a synthetic corpus of clustered 1536-dim unit vectors is generated.
+#
+import os, sys, json, time, argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embeddingstore import build_store, store_size, store_topn, embedding_matrix
+
+def synthetic_corpus(rows, dims=1536, clusters=200, seed=7):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    matrix = centers[rng.integers(0, clusters, rows)] + 0.6 * rng.standard_normal((rows, dims)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1)[:, None]
+
+def load_corpus(filename):
+    import pandas as pd
+    df = pd.read_csv(filename, sep="\t")
+    return embedding_matrix(df.embedding.apply(json.loads))
+
+def sample_queries(matrix, numqueries, seed=11):
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.integers(0, len(matrix), numqueries)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape).astype(np.float32) * np.abs(queries).mean()
+    return queries / np.linalg.norm(queries, axis=1)[:, None]
+
+def run(store, queries, top_n, rescore_n):
+    results = []
+    start = time.perf_counter()
+    for aquery in queries:
+        positions, sims = store_topn(store, aquery, top_n, rescore_n)
+        results.append(set(positions.tolist()))
+    elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+    return results, elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datastore", nargs="?", default="")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top", type=int, default=12)
+    parser.add_argument("--rescore", type=int, default=4, help="rescore top * rescore candidates with float32")
+    args = parser.parse_args()
+
+    if len(args.datastore) > 0:
+        matrix = load_corpus(args.datastore)
+    else:
+        matrix = synthetic_corpus(args.rows)
+    queries = sample_queries(matrix, args.queries)
+    rows, dims = matrix.shape
+    print(f"corpus: {rows} rows x {dims} dims, {len(queries)} queries, top {args.top}")
+    print(f"  python list of floats (estimate): {rows * dims * 32 / 1e6:10.1f} MB")
+    print(f"  float64 numpy arrays            : {rows * dims * 8 / 1e6:10.1f} MB")
+
+    baseline, baselinems = run(build_store(matrix, "float32"), queries, args.top, 0)
+    print(f"{'storage':<18}{'memory MB':>12}{'ms/query':>12}{'top-k agree':>14}")
+    for dtype in ["float32", "float16", "int8"]:
+        store = build_store(matrix, dtype)
+        for rescore in [False, True]:
+            if rescore and dtype == "float32":
+                continue
+            store["exact"] = matrix if rescore else None
+            results, elapsed = run(store, queries, args.top, args.top * args.rescore if rescore else 0)
+            agreement = np.mean([len(a & b) / args.top for a, b in zip(results, baseline)])
+            label = dtype + (" +rescore" if rescore else "")
+            print(f"{label:<18}{store_size(store) / 1e6:12.1f}{elapsed:12.2f}{agreement:14.4f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/local/bin/python3.11
+#
+#  Compare HTML section extractors, parsehtml (old) and parsehtmlsinglepass (new), on the fixture pages and
+#  any saved web pages given: parse time, number of sections (chunks embedded), content chars, and embedding tokens.
+#
+#  usage:
+#     python3 benchmarks/bench_htmlextract.py [--runs 20] [saved pages, such as /tmp/page.html ...]
+#
+#  tokens are counted with tiktoken (embedding encoding), or whitespace words if the encoding can not be loaded.
+#
+import os, sys, time, argparse, statistics
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import openaifuncs
+from webpagedigest import parsehtml, parsehtmlsinglepass
+
+pagedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pages")
+extractors = [("old", parsehtml), ("new", parsehtmlsinglepass)]
+
+def token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(openaifuncs.embedding_encoding)
+        return lambda text: len(encoding.encode(text))
+    except Exception as err:
+        print(f"tiktoken encoding not available, count whitespace words instead -- {type(err).__name__}")
+        return lambda text: len(text.split())
+
+def run_extractor(extractor, pagename, htmltext, runs, counttokens):
+    """
+    :return:  [median ms, number of sections, content chars, embedding tokens]
+    """
+    times = []
+    for arun in range(runs):
+        df = pd.DataFrame(None, columns=['webpage', 'subject', 'content', 'combined'])
+        start = time.perf_counter()
+        df = extractor(df, pagename, htmltext, openaifuncs.maxsectionlength, openaifuncs.ignorelength, openaifuncs.mincontentoverlap)
+        times.append((time.perf_counter() - start) * 1000)
+    return [statistics.median(times), len(df.index), int(df.content.str.len().sum()), sum(counttokens(c) for c in df.combined)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("pages", nargs="*", help="saved HTML pages, in addition to the fixture pages")
+    args = parser.parse_args()
+
+    counttokens = token_counter()
+    pages = [os.path.join(pagedir, p) for p in sorted(os.listdir(pagedir))] + args.pages
+    print(f"{'page':<28}{'extractor':>10}{'ms':>9}{'chunks':>8}{'chars':>9}{'tokens':>9}")
+    totals = {name: [0.0, 0, 0, 0] for name, extractor in extractors}
+    for apage in pages:
+        with open(apage, errors="replace") as pagefile:
+            htmltext = pagefile.read()
+        pagename = os.path.basename(apage)
+        for name, extractor in extractors:
+            row = run_extractor(extractor, pagename, htmltext, args.runs, counttokens)
+            totals[name] = [t + r for t, r in zip(totals[name], row)]
+            print(f"{pagename[:27]:<28}{name:>10}{row[0]:>9.2f}{row[1]:>8}{row[2]:>9}{row[3]:>9}")
+    for name, total in totals.items():
+        print(f"{'total':<28}{name:>10}{total[0]:>9.2f}{total[1]:>8}{total[2]:>9}{total[3]:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/local/bin/python3.11
+#
+#  Measure cold start of openaifuncs (what semanticSearch.py imports):
+#     import time, with python -X importtime, and the heavy dependencies loaded;
+#     time to answer a question against a cached corpus in a new process (import, load the data store, embed the
+#     question, query sections, summarize), with OpenAI network calls stubbed, so lazily imported openai and tiktoken
+#     are counted.
+#
+#  usage:
+#     python3 benchmarks/bench_importtime.py [--baseline <git ref>] [--runs 5] [--sections 200]
+#
+#  with --baseline, the same is measured for the tree at <git ref> (extracted with git archive), for comparison.
+#  the tiktoken encoding is loaded from its cache; if it is not cached (no network), token counts are stubbed too
+#  and the encoding load time is not included.
+#
+import os, sys, json, subprocess, argparse, tempfile, statistics
+
+repodir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavymodules = ["pandas", "numpy", "tiktoken", "openai", "matplotlib", "plotly", "scipy", "sklearn", "pandarallel",
+                "bs4", "py_pdf_parser", "requests_html", "pyppeteer", "requests"]
+probe = "import sys, openaifuncs; print(' '.join(m for m in %r if m in sys.modules))" % heavymodules
+
+def measure(srcdir, runs):
+    """
+    :return:  (median cumulative import time of openaifuncs in ms, heavy modules loaded, top 8 top-level imports)
+    """
+    totals = []
+    toplevel = {}
+    loaded = ""
+    for arun in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=srcdir, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise Exception(f"import failed in {srcdir}: {proc.stderr[-500:]}")
+        loaded = proc.stdout.strip()
+        for aline in proc.stderr.splitlines():
+            if not aline.startswith("import time:") or "cumulative" in aline:
+                continue
+            parts = aline.split("|")
+            cumulative = int(parts[1].strip())
+            name = parts[2].rstrip()
+            if name.strip() == "openaifuncs":
+                totals.append(cumulative / 1000)
+            # top-level imports of openaifuncs are indented by 2 spaces more than openaifuncs itself
+            if name.startswith("   ") and not name.startswith("    "):
+                toplevel.setdefault(name.strip(), []).append(cumulative / 1000)
+    heaviest = sorted(((statistics.median(v), k) for k, v in toplevel.items()), reverse=True)[:8]
+    return statistics.median(totals), loaded, heaviest
+
+questionprobe = r"""
+import sys, time, json
+start = time.perf_counter()
+import openaifuncs
+imported = time.perf_counter()
+df = openaifuncs.get_embedded_dataframe(filename=sys.argv[1])
+loaded = time.perf_counter()
+# the question path imports openai and tiktoken, only network calls are stubbed
+import openai, tiktoken
+dims = int(sys.argv[2])
+class Message:
+    def __init__(self, content):
+        self.message = {"content": content}
+class Completion:
+    def __init__(self, content):
+        self.choices = [Message(content)]
+openai.Embedding.create = lambda **kw: {"data": [{"embedding": [1.0] * dims, "index": i} for i in range(len(kw["input"]) if isinstance(kw["input"], list) else 1)]}
+openai.ChatCompletion.create = lambda **kw: Completion("stub answer from context")
+stubbed = False
+try:
+    tiktoken.get_encoding("cl100k_base")
+except Exception:
+    class Encoding:
+        def encode(self, text):
+            return text.split()
+    tiktoken.get_encoding = lambda name: Encoding()
+    stubbed = True
+answer = openaifuncs.get_answer(df, "What is the stub question about?")
+answered = time.perf_counter()
+print(json.dumps({"import": (imported - start) * 1000, "load": (loaded - imported) * 1000,
+                  "question": (answered - loaded) * 1000, "total": (answered - start) * 1000, "stubbed": stubbed}))
+"""
+
+def make_cached_corpus(workdir, sections, dims=1536):
+    """
+    a cached data store with embeddings as text, as get_embedded_dataframe saves by default
+    """
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(5)
+    texts = [f"Section {i} of the cached corpus, " + "with some words of content " * 40 for i in range(sections)]
+    embeddings = [str((1.0 + 0.05 * rng.standard_normal(dims)).tolist()) for i in range(sections)]
+    df = pd.DataFrame({"webpage": [f"https://example.com/page{i // 4}" for i in range(sections)], "subject": "s",
+                       "content": texts, "combined": texts, "embedding": embeddings, "n_tokens": 300})
+    filename = os.path.join(workdir, "web-cached.csv")
+    df.to_csv(filename, sep="\t")
+    return filename, dims
+
+def measure_question(srcdir, runs, corpusfile, dims):
+    """
+    :return:  (median ms of import, load, question, total in a new process, whether tiktoken encoding was stubbed)
+    """
+    results = []
+    for arun in range(runs):
+        proc = subprocess.run([sys.executable, "-c", questionprobe, corpusfile, str(dims)], cwd=srcdir, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise Exception(f"question failed in {srcdir}: {proc.stderr[-500:]}")
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    medians = [statistics.median(r[key] for r in results) for key in ["import", "load", "question", "total"]]
+    return medians, results[-1]["stubbed"]
+
+def report_question(label, result):
+    (importms, loadms, questionms, totalms), stubbed = result
+    print(f"{label}: cached-corpus question {totalms:8.1f} ms  (import {importms:.1f}, load data store {loadms:.1f}, "
+          f"question {questionms:.1f})" + ("  [tiktoken encoding stubbed]" if stubbed else ""))
+
+def report(label, result):
+    total, loaded, heaviest = result
+    print(f"{label}: import openaifuncs {total:8.1f} ms")
+    print(f"    heavy modules loaded: {loaded if len(loaded) > 0 else '(none)'}")
+    for ms, name in heaviest:
+        print(f"    {ms:8.1f} ms  {name}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", default="", help="git ref to compare with, such as HEAD~1")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--sections", type=int, default=200, help="number of sections in the cached corpus")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        corpusfile, dims = make_cached_corpus(workdir, args.sections)
+        if len(args.baseline) > 0:
+            with tempfile.TemporaryDirectory() as basedir:
+                archive = subprocess.run(["git", "archive", args.baseline], cwd=repodir, capture_output=True, check=True)
+                subprocess.run(["tar", "-x", "-C", basedir], input=archive.stdout, check=True)
+                report(f"baseline {args.baseline}", measure(basedir, args.runs))
+                report_question(f"baseline {args.baseline}", measure_question(basedir, args.runs, corpusfile, dims))
+        report("current", measure(repodir, args.runs))
+        report_question("current", measure_question(repodir, args.runs, corpusfile, dims))
+
+if __name__ == "__main__":
+    main()
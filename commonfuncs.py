@@ -1,5 +1,5 @@
-import sys, time, hashlib, asyncio, traceback
-from requests_html import AsyncHTMLSession
+import sys, os, time, hashlib, asyncio, traceback, random, tempfile, urllib.parse
+import concurrent.futures as cf
 
 def canonicalize(userstr):
     """
@@ -33,48 +33,206 @@ def getFilenameHash(webpages, questionstr):
     retstr = hashlib.sha512(hashstrencoded).hexdigest()[:16]
     return retstr
 
-async def retrieveWebpage(url):
+#  fetch scheduler settings
+fetch_max_concurrency  = 16    # concurrent fetches in total
+fetch_host_concurrency = 4     # concurrent fetches per host
+fetch_retries = 3              # retries for transient errors (connection errors, timeouts, 429 and 5xx)
+fetch_backoff = 1.0            # in seconds, backoff before first retry, doubled for each retry, with jitter
+fetch_max_bodysize = 64 * 1024 * 1024   # larger response bodies are discarded
+fetch_chunksize = 256 * 1024
+transient_status = [408, 429, 500, 502, 503, 504]
+
+# use custom user-agent
+customUA = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 GZPython3/OpenAI'}
+
+fetchstats_failed = []   # statistics of failed fetches, in the current batch
+fetch_skipped = []       # urls cancelled at the deadline, in the current batch
+# response bodies are read in these threads, not the default executor, so a batch does not wait for them at the deadline
+fetch_executor = cf.ThreadPoolExecutor(max_workers=fetch_max_concurrency, thread_name_prefix="fetch")
+
+class TransientFetchError(Exception):
+    pass
+
+def readBody(r, deadline=None):
+    """
+    read response body in chunks, up to fetch_max_bodysize.  PDF bodies are streamed to a temp file instead of memory,
+    the temp file name is set as r.bodyfile.
+
+    :param r:    a streamed response
+    :param deadline:  time (as time.time()) to stop reading, None for no limit
+    :return:  number of bytes read
+    """
+    spill = 'application/pdf' in r.headers.get('Content-Type', '').lower()
+    chunks = []
+    bodysize = 0
+    bodyfile = None
     try:
-        session = AsyncHTMLSession()
-
-        # use custom user-agent
-        customUA = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 GZPython3/OpenAI'}
-        # set connect timeout and read timeout, in seconds, retreiev first page load
-        r = await session.get(url, headers=customUA, timeout=(4, 10.0))
-        ct = r.headers['Content-Type']
-        if 'text/html' in ct:
-            try:
-                # to be safe, wait for 5.0 seconds (default 0.2) before calling JS render,
-                # and JS render timeout after 30 seconds (default infinity) to avoid JS loop or manual interaction
-                # JS render will launch chrome driver.
-                log(f"Before rendering {url=} " + (" " * 10), endstr="\r")
-                await r.html.arender(timeout=10)
-                # await r.html.arender(wait=5.0, timeout=20)
-            except Exception as renderErr:
-                log(f'Failed to render {url}: {renderErr}, continue to use raw content    ', endstr="\n", outfile=sys.stdout)
-                traceback.print_exc(limit=6, file=sys.stderr, chain=True)
-        await session.close()
-        log(f"Done loading {url[:80]}" + (" " * 10), endstr="\r")
-        return r
-    except Exception as err:
-        log(f"FAILED to load {url=} -- {err}\n", outfile=sys.stderr)
-        traceback.print_exc(limit=8, file=sys.stderr, chain=True)
-        return None
-
-async def batchTasks(webs):
-    tasks = (retrieveWebpage(url) for url in webs)
-    return await asyncio.gather(*tasks)
-
-def getAsyncWebResponses(urls):
+        if spill:
+            bodyfile = tempfile.NamedTemporaryFile(prefix='web', suffix='.pdf', delete=False)
+            r.bodyfile = bodyfile.name
+        for chunk in r.iter_content(chunk_size=fetch_chunksize):
+            bodysize += len(chunk)
+            if bodysize > fetch_max_bodysize:
+                raise Exception(f"response body exceeds {fetch_max_bodysize} bytes")
+            if deadline != None and time.time() > deadline:
+                raise Exception("deadline exceeded while reading response body")
+            if spill:
+                bodyfile.write(chunk)
+            else:
+                chunks.append(chunk)
+    except Exception:
+        if bodyfile != None:
+            bodyfile.close()
+            os.remove(bodyfile.name)
+            r.bodyfile = None
+        raise
+    finally:
+        r.close()
+    if bodyfile != None:
+        bodyfile.close()
+    r._content = b''.join(chunks)
+    r._content_consumed = True
+    return bodysize
+
+def remainingTime(deadline, limit):
+    """
+    :param deadline:  time (as time.time()) to finish, None for no limit
+    :param limit:     the usual time limit, in seconds
+    :return:  time limit in seconds, the usual limit or less if the deadline comes first, 0 if it has passed
+    """
+    if deadline == None:
+        return limit
+    return max(0.0, min(limit, deadline - time.time()))
+
+async def retrieveWebpage(url, render=True, globalsem=None, hostsems=None, deadline=None):
+    """
+    retrieve a web page, within global and per-host concurrency limits, retry on transient errors.
+    fetch statistics (queue wait, transfer and render time, in seconds) are set as r.fetchstats
+
+    :param url:         the URL
+    :param render:      if True, render HTML pages with JavaScript
+    :param globalsem:   semaphore for global concurrency
+    :param hostsems:    dictionary of host name -> semaphore for per-host concurrency
+    :param deadline:    time (as time.time()) to finish, render and retries are skipped when there is not enough time
+    :return:  request-html response object, or None for failure
+    """
+    import requests
+    from requests_html import AsyncHTMLSession
+    stats = {"url": url, "queue": 0.0, "transfer": 0.0, "render": 0.0, "bytes": 0, "attempts": 0}
+    if globalsem == None:
+        globalsem = asyncio.Semaphore(fetch_max_concurrency)
+    if hostsems == None:
+        hostsems = {}
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    hostsem = hostsems.setdefault(host, asyncio.Semaphore(fetch_host_concurrency))
+
+    while True:
+        stats["attempts"] += 1
+        queuestart = time.time()
+        transferstart = queuestart
+        try:
+            async with hostsem, globalsem:
+                stats["queue"] += time.time() - queuestart
+                transferstart = time.time()
+                session = AsyncHTMLSession()
+                try:
+                    # set connect timeout and read timeout, in seconds, retreiev first page load
+                    r = await session.get(url, headers=customUA, timeout=(4, max(1.0, remainingTime(deadline, 10.0))), stream=True)
+                    if r.status_code in transient_status:
+                        r.close()
+                        raise TransientFetchError(f"HTTP status {r.status_code}")
+                    stats["bytes"] = await asyncio.get_running_loop().run_in_executor(fetch_executor, readBody, r, deadline)
+                    stats["transfer"] += time.time() - transferstart
+
+                    ct = r.headers.get('Content-Type', '')
+                    if render and 'text/html' in ct and remainingTime(deadline, 10) >= 1:
+                        renderstart = time.time()
+                        try:
+                            # to be safe, wait for 5.0 seconds (default 0.2) before calling JS render,
+                            # and JS render timeout after 30 seconds (default infinity) to avoid JS loop or manual interaction
+                            # JS render will launch chrome driver.
+                            log(f"Before rendering {url=} " + (" " * 10), endstr="\r")
+                            await r.html.arender(timeout=remainingTime(deadline, 10))
+                            # await r.html.arender(wait=5.0, timeout=20)
+                        except Exception as renderErr:
+                            log(f'Failed to render {url}: {renderErr}, continue to use raw content    ', endstr="\n", outfile=sys.stdout)
+                            traceback.print_exc(limit=6, file=sys.stderr, chain=True)
+                        stats["render"] = time.time() - renderstart
+                finally:
+                    await session.close()
+            log(f"Done loading {url[:80]}" + (" " * 10), endstr="\r")
+            r.fetchstats = stats
+            return r
+        except (TransientFetchError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            stats["transfer"] += time.time() - transferstart
+            if stats["attempts"] > fetch_retries:
+                log(f"FAILED to load {url=} after {stats['attempts']} attempts -- {err}\n", outfile=sys.stderr)
+                break
+            backoff = fetch_backoff * (2 ** (stats["attempts"] - 1)) * random.uniform(0.5, 1.5)
+            if remainingTime(deadline, backoff + 1) < backoff + 1:
+                log(f"FAILED to load {url=}, no time to retry -- {err}\n", outfile=sys.stderr)
+                break
+            log(f"Retry {url[:80]} in {backoff:.1f} seconds -- {err}" + (" " * 10), endstr="\n", outfile=sys.stderr)
+            await asyncio.sleep(backoff)
+        except Exception as err:
+            log(f"FAILED to load {url=} -- {err}\n", outfile=sys.stderr)
+            traceback.print_exc(limit=8, file=sys.stderr, chain=True)
+            break
+    fetchstats_failed.append(stats)
+    return None
+
+async def batchTasks(webs, render=True, deadline=None):
+    globalsem = asyncio.Semaphore(fetch_max_concurrency)
+    hostsems = {}
+    tasks = [asyncio.ensure_future(retrieveWebpage(url, render, globalsem, hostsems, deadline)) for url in webs]
+    if deadline == None:
+        return await asyncio.gather(*tasks)
+
+    # at the deadline, cancel outstanding fetches and renders, continue with finished pages
+    done, pending = await asyncio.wait(tasks, timeout=remainingTime(deadline, float("inf")))
+    for atask in pending:
+        atask.cancel()
+    if len(pending) > 0:
+        await asyncio.gather(*pending, return_exceptions=True)
+    responses = []
+    for url, atask in zip(webs, tasks):
+        if atask in done:
+            responses.append(atask.result())
+        else:
+            log(f"Skip {url[:80]}, not loaded before the deadline" + (" " * 10), endstr="\n")
+            fetch_skipped.append(url)
+            responses.append(None)
+    return responses
+
+def logFetchStats(responses):
+    """
+    log queue wait, transfer and render time per url
+
+    :param responses:  a list of response objects, with fetchstats
+    """
+    allstats = [r.fetchstats for r in responses if r != None and hasattr(r, 'fetchstats')] + fetchstats_failed
+    if len(allstats) == 0:
+        return
+    log(f"Fetched {len(allstats)} urls, queue/transfer/render in seconds:" + (" " * 30), endstr="\n")
+    for stats in allstats:
+        log(f"  {stats['queue']:6.2f} {stats['transfer']:6.2f} {stats['render']:6.2f}  {stats['bytes']:>10} bytes  "
+            f"{stats['attempts']} attempts  {stats['url'][:80]}", endstr="\n")
+
+def getAsyncWebResponses(urls, render=True, deadline=None):
     """
     With a list of urls, asynchronously retrieve http response
     return a list of html response objects.
 
     :param urls:  a list of URLs
-    :return:     a list of request-html response object
+    :param render:  if True, render HTML pages with JavaScript (headless browser), otherwise keep raw HTML
+    :param deadline:  time (as time.time()) to finish, outstanding fetches are cancelled and listed in fetch_skipped
+    :return:     a list of request-html response object, None for failed or skipped urls
     """
+    fetchstats_failed.clear()
+    fetch_skipped.clear()
     # responses = asyncio.run(batchTasks(urls), debug=True)
-    responses = asyncio.run(batchTasks(urls))
+    responses = asyncio.run(batchTasks(urls, render, deadline))
+    logFetchStats(responses)
     return responses
 
 
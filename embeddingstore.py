@@ -0,0 +1,241 @@
+#
+#  Embedding store, keep embeddings of a dataframe as one matrix, optionally quantized
+#     float32 - full precision
+#     float16 - half precision, half of memory
+#     int8    - 8-bit integer codes with per-vector scale, quarter of memory
+#
+#  Similarity is computed on quantized codes, block by block into a small reused float32 buffer (numpy has no
+#  float16 or int8 matrix product with BLAS speed); int8 scales are applied to the scores, not to the codes.
+#  Full precision embeddings can be kept on disk (memory mapped), to rescore the top candidates exactly.
+#
+import os
+import numpy as np
+from commonfuncs import log
+
+storage_types = ["float32", "float16", "int8"]
+blockrows = 256     # rows per block when scoring quantized codes, a block fits in CPU cache
+half_exponent_bias = np.float32(2.0 ** 112)   # float32 exponent bias 127 - float16 exponent bias 15
+
+def embedding_matrix(embeddings, dims=0):
+    """
+    stack a sequence of embeddings (lists or arrays) into a float32 matrix.
+    missing embeddings (such as 0.0 for empty text) become zero vectors.
+
+    :param embeddings:  a sequence of embeddings
+    :param dims:        number of dimensions, if 0, taken from the first valid embedding
+    :return:  float32 matrix, one row per embedding
+    """
+    embeddings = list(embeddings)
+    if dims == 0:
+        for anembedding in embeddings:
+            if hasattr(anembedding, "__len__"):
+                dims = len(anembedding)
+                break
+    matrix = np.zeros((len(embeddings), dims), dtype=np.float32)
+    for i, anembedding in enumerate(embeddings):
+        if hasattr(anembedding, "__len__") and len(anembedding) == dims:
+            matrix[i] = anembedding
+    return matrix
+
+def build_store(matrix, dtype="float32", backend="openai"):
+    """
+    build an embedding store from a float32 matrix
+
+    :param matrix:   float32 matrix, one row per embedding
+    :param dtype:    one of storage_types
+    :param backend:  the embedding backend that created the embeddings, queries must use the same backend
+    :return:  a dict {'dtype', 'backend', 'dims', 'codes', 'scales', 'norms', 'exact'}
+    """
+    if dtype not in storage_types:
+        raise Exception(f"unknown embedding storage type {dtype}, should be one of {storage_types}")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(matrix / scales[:, None]).astype(np.int8)
+        scales = scales.astype(np.float32)
+    else:
+        codes = matrix.astype(dtype)
+    store = {"dtype": dtype, "backend": backend, "dims": matrix.shape[1], "codes": codes, "scales": scales, "exact": None}
+    store["norms"] = _row_norms(store)
+    return store
+
+def _dequantize(codes, scales):
+    block = codes.astype(np.float32)
+    if scales is not None:
+        block *= scales[:, None]
+    return block
+
+def _codes_to_float32(codes, out):
+    """
+    convert a block of quantized codes into a float32 buffer, without allocating a float32 block
+
+    :param codes:  int8 or float16 codes
+    :param out:    contiguous float32 buffer, same shape as codes
+    """
+    if codes.dtype != np.float16:
+        np.copyto(out, codes, casting="unsafe")
+        return
+    # exact float16 -> float32 by moving exponent and mantissa bits into place, faster than astype;
+    # scaling by 2^112 corrects the exponent bias, also for subnormals
+    bits = out.view(np.uint32)
+    np.copyto(bits, codes.view(np.uint16))
+    sign = (bits & 0x8000) << 16
+    bits &= 0x7fff
+    bits <<= 13
+    out *= half_exponent_bias
+    bits |= sign
+
+def _row_norms(store):
+    codes = store["codes"]
+    scales = store["scales"]
+    norms = np.zeros(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], blockrows):
+        end = start + blockrows
+        block = _dequantize(codes[start:end], None if scales is None else scales[start:end])
+        norms[start:end] = np.linalg.norm(block, axis=1)
+    norms[norms == 0] = 1.0
+    return norms
+
+def store_size(store):
+    """
+    :return:  number of bytes held in memory by the store (memory mapped exact embeddings are not counted)
+    """
+    size = store["codes"].nbytes + store["norms"].nbytes
+    if store["scales"] is not None:
+        size += store["scales"].nbytes
+    return size
+
+def store_vectors(store, positions):
+    """
+    :param store:      the embedding store
+    :param positions:  row positions
+    :return:  float32 matrix of embeddings at positions, exact if full precision embeddings are available
+    """
+    positions = np.asarray(positions)
+    if store["exact"] is not None:
+        return np.asarray(store["exact"][positions], dtype=np.float32)
+    scales = None if store["scales"] is None else store["scales"][positions]
+    return _dequantize(store["codes"][positions], scales)
+
+def store_similarity(store, queries):
+    """
+    cosine similarity of every stored embedding to one or more query embeddings, computed on quantized codes.
+
+    :param store:    the embedding store
+    :param queries:  a query embedding, or a matrix with one query per row
+    :return:  similarity vector (one query), or matrix of (stored rows x queries)
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    single = queries.ndim == 1
+    if single:
+        queries = queries[None, :]
+    qnorms = np.linalg.norm(queries, axis=1)
+    qnorms[qnorms == 0] = 1.0
+    queries = queries / qnorms[:, None]
+
+    codes = store["codes"]
+    if codes.dtype == np.float32:
+        sims = codes @ queries.T
+    else:
+        sims = np.zeros((codes.shape[0], queries.shape[0]), dtype=np.float32)
+        block = np.empty((blockrows, codes.shape[1]), dtype=np.float32)
+        for start in range(0, codes.shape[0], blockrows):
+            end = min(start + blockrows, codes.shape[0])
+            _codes_to_float32(codes[start:end], block[:end - start])
+            np.dot(block[:end - start], queries.T, out=sims[start:end])
+        if store["scales"] is not None:
+            sims *= store["scales"][:, None]
+    sims /= store["norms"][:, None]
+    if single:
+        return sims[:, 0]
+    return sims
+
+def store_topn(store, query, top_n=5, rescore_n=0, sims=None):
+    """
+    find the most similar stored embeddings to a query embedding
+
+    :param store:     the embedding store
+    :param query:     the query embedding
+    :param top_n:     number of results
+    :param rescore_n: if > top_n and full precision embeddings are available,
+                      rescore this number of candidates with full precision before picking top_n
+    :param sims:      similarity of stored embeddings to the query, if already computed with store_similarity
+    :return:  (positions, similarities), sorted by similarity descending
+    """
+    if sims is None:
+        sims = store_similarity(store, query)
+    numcands = max(top_n, rescore_n) if store["exact"] is not None else top_n
+    numcands = min(numcands, len(sims))
+    if numcands <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    cands = np.argpartition(-sims, numcands - 1)[:numcands]
+    candsims = sims[cands]
+    if numcands > top_n:
+        candsims = cosine_rows(store_vectors(store, cands), query)
+    order = np.argsort(-candsims)[:top_n]
+    return cands[order], candsims[order]
+
+def cosine_similarity(a, b):
+    """
+    :return:  cosine similarity of two embeddings
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    norms = np.linalg.norm(a) * np.linalg.norm(b)
+    if norms == 0:
+        return 0.0
+    return float(np.dot(a, b) / norms)
+
+def cosine_rows(matrix, query):
+    query = np.asarray(query, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = 1.0
+    return (matrix @ query) / norms
+
+def store_filenames(embeddingfilename):
+    """
+    :param embeddingfilename:  the dataframe store filename
+    :return:  (quantized store filename, full precision filename)
+    """
+    basename = os.path.splitext(embeddingfilename)[0]
+    return basename + "-emb.npz", basename + "-f32.npy"
+
+def save_store(store, embeddingfilename, matrix=None):
+    """
+    save the embedding store next to the dataframe store, optionally with full precision embeddings for rescoring
+
+    :param store:    the embedding store
+    :param embeddingfilename:  the dataframe store filename
+    :param matrix:   full precision float32 matrix, saved as .npy to be memory mapped
+    """
+    storefilename, exactfilename = store_filenames(embeddingfilename)
+    scales = store["scales"] if store["scales"] is not None else np.zeros(0, dtype=np.float32)
+    with open(storefilename, "wb") as storefile:
+        np.savez(storefile, dtype=np.array(store["dtype"]), backend=np.array(store["backend"]),
+                 codes=store["codes"], scales=scales, norms=store["norms"])
+    if matrix is not None:
+        np.save(exactfilename, np.asarray(matrix, dtype=np.float32))
+    log(f"Saved {store['backend']} {store['dims']}-dim {store['dtype']} embedding store {storefilename}, {store_size(store)} bytes" + (" " * 20), endstr="\n")
+
+def load_store(embeddingfilename):
+    """
+    load the embedding store saved with the dataframe store; full precision embeddings, if saved, are memory mapped
+
+    :param embeddingfilename:  the dataframe store filename
+    :return:  the embedding store, or None if there is no saved store
+    """
+    storefilename, exactfilename = store_filenames(embeddingfilename)
+    if not os.path.isfile(storefilename):
+        return None
+    with np.load(storefilename) as npz:
+        scales = npz["scales"]
+        store = {"dtype": str(npz["dtype"]), "codes": npz["codes"], "norms": npz["norms"],
+                 "scales": scales if len(scales) > 0 else None,
+                 "backend": str(npz["backend"]) if "backend" in npz.files else "openai"}
+    store["dims"] = store["codes"].shape[1]
+    store["exact"] = None
+    if os.path.isfile(exactfilename):
+        store["exact"] = np.load(exactfilename, mmap_mode="r")
+    return store
@@ -0,0 +1,62 @@
+#
+#  Local embedding backend, CPU only and no network:
+#     hashing vectorizer (words and word pairs) -> TF-IDF weighting -> truncated SVD (latent semantic analysis)
+#  the model is fitted on the corpus, in one batch, and saved with the data store to embed questions later.
+#
+#  package installed:
+#     /usr/local/bin/python3 -m pip install scikit-learn
+#
+#  scikit-learn is imported when a model is fitted or loaded, not needed for OpenAI embeddings.
+#
+import os, pickle
+import numpy as np
+from commonfuncs import log
+
+local_embedding_dims = 256     # SVD components, fewer for small corpora (at most number of sections - 1)
+
+def fit_local_model(texts, dims=local_embedding_dims):
+    """
+    fit a local embedding model on corpus texts, and embed them
+
+    :param texts:   a list of texts, such as 'combined' column
+    :param dims:    number of dimensions
+    :return:  (model, float32 matrix with one row per text)
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    from sklearn.decomposition import TruncatedSVD
+    vectorizer = HashingVectorizer(n_features=2**18, ngram_range=(1, 2), stop_words='english', alternate_sign=False, norm=None)
+    tfidf = TfidfTransformer(sublinear_tf=True)
+    counts = vectorizer.transform(texts)
+    weighted = tfidf.fit_transform(counts)
+    dims = max(1, min(dims, weighted.shape[0] - 1))
+    svd = TruncatedSVD(n_components=dims, algorithm='randomized', random_state=0)
+    matrix = svd.fit_transform(weighted)
+    model = {"vectorizer": vectorizer, "tfidf": tfidf, "svd": svd, "dims": dims}
+    log(f"Fitted local embedding model, {len(texts)} texts, {dims} dimensions" + (" " * 20), endstr="\n")
+    return model, _normalize(matrix)
+
+def local_embed(model, texts):
+    """
+    :param model:   local embedding model, from fit_local_model
+    :param texts:   a list of texts
+    :return:  float32 matrix with one row per text
+    """
+    weighted = model["tfidf"].transform(model["vectorizer"].transform(texts))
+    return _normalize(model["svd"].transform(weighted))
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    return matrix / norms[:, None]
+
+def model_filename(embeddingfilename):
+    return os.path.splitext(embeddingfilename)[0] + "-model.pkl"
+
+def save_local_model(model, embeddingfilename):
+    with open(model_filename(embeddingfilename), "wb") as modelfile:
+        pickle.dump(model, modelfile)
+
+def load_local_model(embeddingfilename):
+    with open(model_filename(embeddingfilename), "rb") as modelfile:
+        return pickle.load(modelfile)
@@ -0,0 +1,221 @@
+#
+#  Multi-corpus search, each data store (such as /tmp/web-<hash>.csv, or a personal knowledge base) is a shard.
+#  Shards are loaded lazily when queried, a limited number are kept in memory (least recently used are dropped).
+#  Shards are searched in parallel, in priority tiers: lower priority shards are only searched
+#  when higher priority shards do not have enough relevant sections.  Results are merged by weighted similarity.
+#
+#  A shard loaded once gets a small routing summary (centroids of its section embeddings), saved as <name>-route.npz.
+#  In a tier with more than shard_route_n shards, a question is routed to the shard_route_n shards whose summaries
+#  are most similar (weighted), other shards are not loaded.  Shards without a summary yet, or with an embedding model
+#  fitted for each shard (local backend), are always searched; for those only priorities prune the search.
+#
+import os, sys, threading, collections
+import concurrent.futures as cf
+import numpy as np
+import pandas as pd
+from commonfuncs import log
+from openaifuncs import load_embedding_store, get_embedding_store, embed_queries, select_sections, answer_with_sections, \
+    relevance_threshold, rescore_factor, get_backend
+from embeddingstore import store_topn, store_vectors
+
+max_loaded_shards = 8       # shards kept in memory, least recently used shards are dropped
+shard_workers = 8           # shards searched in parallel
+shard_route_n = 8           # shards searched in a priority tier for a question, chosen by routing summaries; 0 for all
+shard_route_clusters = 16   # routing summary of a shard, centroids of this many clusters of section embeddings
+
+shard_summaries = {}        # filename -> routing summary {"backend", "centroids"}, a few KB each, kept for all shards
+
+loaded_shards = collections.OrderedDict()    # filename -> dataframe, in least recently used order
+shards_lock = threading.Lock()
+
+def shard_spec(ashard):
+    """
+    :param ashard:  a data store filename, or a dict {"filename", "weight" (default 1.0), "priority" (default 0)}
+    :return:  dict {"filename", "weight", "priority"}
+    """
+    if isinstance(ashard, str):
+        ashard = {"filename": ashard}
+    return {"filename": ashard["filename"], "weight": ashard.get("weight", 1.0), "priority": ashard.get("priority", 0)}
+
+def summary_filename(filename):
+    return os.path.splitext(filename)[0] + "-route.npz"
+
+def build_shard_summary(store, clusters=shard_route_clusters, iterations=8):
+    """
+    routing summary of a shard, centroids of its section embeddings clustered with spherical k-means
+
+    :param store:     the shard's embedding store
+    :param clusters:  maximum number of centroids
+    :return:  dict {"backend", "centroids"}, centroids are unit vectors, one per row
+    """
+    vectors = store_vectors(store, np.arange(len(store["codes"])))
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    vectors = vectors / norms[:, None]
+    # start from evenly spaced sections, sections of a web page are adjacent
+    centroids = vectors[np.linspace(0, len(vectors) - 1, min(clusters, len(vectors))).astype(int)]
+    for aniteration in range(iterations if len(vectors) > 0 else 0):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(len(centroids)):
+            members = vectors[assignment == c]
+            if len(members) > 0:
+                centroids[c] = members.sum(axis=0)
+        cnorms = np.linalg.norm(centroids, axis=1)
+        cnorms[cnorms == 0] = 1.0
+        centroids = centroids / cnorms[:, None]
+    return {"backend": store["backend"], "centroids": centroids.astype(np.float32)}
+
+def get_shard_summary(filename):
+    """
+    :param filename:   the data store filename
+    :return:  routing summary of the shard, from memory or <name>-route.npz, or None if not built or out of date
+    """
+    if filename in shard_summaries:
+        return shard_summaries[filename]
+    routefilename = summary_filename(filename)
+    if not os.path.isfile(routefilename) or os.path.getmtime(routefilename) < os.path.getmtime(filename):
+        return None
+    with np.load(routefilename) as npz:
+        summary = {"backend": str(npz["backend"]), "centroids": npz["centroids"]}
+    shard_summaries[filename] = summary
+    return summary
+
+def load_shard(filename):
+    """
+    load a shard's data store and embedding store, or take it from memory if recently used.
+    a routing summary is built and saved on first load.
+
+    :param filename:   the data store filename
+    :return:  dataframe, with embedding store
+    """
+    with shards_lock:
+        if filename in loaded_shards:
+            loaded_shards.move_to_end(filename)
+            return loaded_shards[filename]
+    log(f"Load shard {filename}" + (" " * 40), endstr="\r")
+    df = load_embedding_store(pd.read_csv(filename, sep="\t"), filename)
+    if get_shard_summary(filename) is None:
+        summary = build_shard_summary(get_embedding_store(df))
+        with open(summary_filename(filename), "wb") as routefile:
+            np.savez(routefile, backend=np.array(summary["backend"]), centroids=summary["centroids"])
+        shard_summaries[filename] = summary
+    with shards_lock:
+        loaded_shards[filename] = df
+        while len(loaded_shards) > max_loaded_shards:
+            loaded_shards.popitem(last=False)
+    return df
+
+def search_shard(shardno, spec, userq, top_n, queryembeddings, embeddings_lock):
+    """
+    search one shard for top_n relevant sections
+
+    :return:  (dataframe of relevant sections with 'score' and 'shard' columns, dictionary of index -> embedding)
+    """
+    df = load_shard(spec["filename"])
+    store = get_embedding_store(df)
+    # question embedding is shared by shards of the same backend, unless the backend model is fitted for each shard
+    embeddingkey = store["backend"] if get_backend(store["backend"])["load"] is None else spec["filename"]
+    with embeddings_lock:
+        if embeddingkey not in queryembeddings:
+            queryembeddings[embeddingkey] = embed_queries(store, [userq])[0]
+        searchword = queryembeddings[embeddingkey]
+
+    positions, similarities = store_topn(store, searchword, top_n, rescore_n=top_n * rescore_factor)
+    topdf = df.iloc[positions][["webpage", "subject", "content", "n_tokens"]].copy()
+    topdf.insert(1, "similarity", similarities)
+    topdf["score"] = topdf["similarity"] * spec["weight"]
+    topdf["shard"] = spec["filename"]
+    relevant = topdf["similarity"] >= relevance_threshold(store)
+    topdf = topdf.loc[relevant]
+    # index unique across shards, and consecutive within a shard, so adjacent sections can still be merged
+    topdf.index = [shardno * 1000000000 + p for p in positions[relevant.to_numpy()]]
+    vectors = dict(zip(topdf.index, store_vectors(store, positions[relevant.to_numpy()])))
+    return topdf, vectors
+
+def route_shards(tiershards, userq, queryembeddings, embeddings_lock):
+    """
+    choose shards of a priority tier to search for a question, the shard_route_n shards with the highest
+    weighted similarity of the question to their routing summaries.  shards without a summary,
+    or with an embedding model fitted for each shard, can not be routed and are always searched.
+
+    :param tiershards:  a list of (shard no, shard spec) of a priority tier
+    :param userq:       user question
+    :return:  a list of (shard no, shard spec) to search
+    """
+    if shard_route_n <= 0 or len(tiershards) <= shard_route_n:
+        return tiershards
+    searched = []
+    scored = []
+    for shardno, spec in tiershards:
+        summary = get_shard_summary(spec["filename"])
+        if summary is None or get_backend(summary["backend"])["load"] is not None or len(summary["centroids"]) == 0:
+            searched.append((shardno, spec))
+            continue
+        with embeddings_lock:
+            if summary["backend"] not in queryembeddings:
+                queryembeddings[summary["backend"]] = get_backend(summary["backend"])["embed_queries"](None, [userq])[0]
+            query = np.asarray(queryembeddings[summary["backend"]], dtype=np.float32)
+        qnorm = max(float(np.linalg.norm(query)), 1e-12)
+        scored.append((spec["weight"] * float((summary["centroids"] @ query).max()) / qnorm, shardno, spec))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    searched += [(shardno, spec) for score, shardno, spec in scored[:shard_route_n]]
+    log(f"route question to {len(searched)} of {len(tiershards)} shards" + (" " * 20), endstr="\r")
+    return searched
+
+def search_shards(shards, userq, top_n=6):
+    """
+    search many shards for the most relevant sections to a question
+
+    :param shards:   a list of shards, data store filenames or dicts {"filename", "weight", "priority"}
+    :param userq:    user question
+    :param top_n:    number of sections returned
+    :return:  (dataframe of top sections [webpage, similarity, subject, content, n_tokens, score, shard],
+               dictionary of index -> embedding)
+    """
+    specs = [shard_spec(ashard) for ashard in shards]
+    tiers = sorted(set(spec["priority"] for spec in specs), reverse=True)
+    queryembeddings = {}
+    embeddings_lock = threading.Lock()
+    resultdfs = []
+    vectors = {}
+    with cf.ThreadPoolExecutor(max_workers=shard_workers) as executor:
+        for tier in tiers:
+            tiershards = [(shardno, spec) for shardno, spec in enumerate(specs) if spec["priority"] == tier]
+            fs = []
+            for shardno, spec in route_shards(tiershards, userq, queryembeddings, embeddings_lock):
+                fs.append(executor.submit(search_shard, shardno, spec, userq, top_n, queryembeddings, embeddings_lock))
+            for af in fs:
+                try:
+                    topdf, topvectors = af.result()
+                    resultdfs.append(topdf)
+                    vectors.update(topvectors)
+                except Exception as err:
+                    log(f"Failed to search shard -- {err=}", endstr="\n", outfile=sys.stderr)
+            numrelevant = sum(len(adf.index) for adf in resultdfs)
+            if numrelevant >= top_n:
+                log(f"found {numrelevant} relevant sections in shards with priority {tier} or above" + (" " * 20), endstr="\r")
+                break
+
+    if len(resultdfs) == 0:
+        return None, vectors
+    mergeddf = pd.concat(resultdfs).sort_values(by="score", ascending=False).head(top_n)
+    return mergeddf, vectors
+
+def get_answer_multi(shards, userq, top_n=6):
+    """
+    answer a question from many corpora (shards), see search_shards
+
+    :param shards:   a list of shards, data store filenames or dicts {"filename", "weight", "priority"}
+    :param userq:    user question
+    :param top_n:    number of top sections to generate answers
+    :return:  answer object {"answer", "references"}
+    """
+    log(f"search {len(shards)} shards ... {userq=}            ", endstr="\r")
+    topdf, vectors = search_shards(shards, userq, top_n)
+    selecteddf = None
+    if topdf is not None and len(topdf.index) > 0:
+        log(f"selected {len(topdf.index)} most relevant sections from {topdf.shard.nunique()} shards to generate answers...", endstr="\r")
+        selecteddf = select_sections(None, topdf, vectors=vectors, relevance="score")
+    else:
+        log("no relevant data from your materials, use OpenAI to generate answers...")
+    return answer_with_sections(userq, selecteddf)
@@ -1,10 +1,17 @@
-import traceback, tiktoken, time, openai, os, sys, json
+#
+#  heavy dependencies (openai, tiktoken, and through webpagedigest and localembedding: bs4, py_pdf_parser,
+#  requests_html, scikit-learn) are imported in the functions that need them, so a question against
+#  a cached corpus starts fast.
+#
+import traceback, time, os, sys, json, weakref, threading
+import concurrent.futures as cf
 import pandas as pd
-import numpy as np
-from openai.embeddings_utils import cosine_similarity
-from pandarallel import pandarallel
-from commonfuncs import log, getFilenameHash, getAsyncWebResponses
-from webpagedigest import extractWebContents, extractWebContentsParallel, getBingSearchLinks
+import commonfuncs
+from commonfuncs import log, getFilenameHash, getAsyncWebResponses, canonicalize, remainingTime
+from webpagedigest import extractWebContents, extractWebContentsParallel, getSearchLinks, bingSearchLinks, dedupeWebContents
+from embeddingstore import embedding_matrix, build_store, save_store, load_store, store_topn, store_vectors, store_similarity, \
+    cosine_similarity
+from localembedding import fit_local_model, local_embed, save_local_model, load_local_model, local_embedding_dims
 
 #########################################
 #  OpenAI model and chunk size
@@ -22,6 +29,22 @@ mincontentoverlap = 400     # in char, about 50 words, enough to not break up a
 ignorelength =  30          # indexed content should have more than min content length
 embedding_model="text-embedding-ada-002"
 embedding_encoding="cl100k_base"  # this the encoding for text-embedding-ada-002
+embedding_backend = "openai"  # a key of embedding_backends: openai - embedding_model via OpenAI API;
+                              # local - scikit-learn TF-IDF and SVD, no network
+embedding_storage = "float32" # float32 keeps OpenAI embeddings as text in the data store;
+                              # float16 or int8 keeps quantized embeddings in <name>-emb.npz, full precision in <name>-f32.npy
+rescore_factor = 4            # with quantized storage, rescore top_n * rescore_factor candidates in full precision
+answer_workers = 4            # sections queried for answers concurrently
+summary_reserve = 8           # in seconds, with a deadline, section answers stop this much earlier to leave time for summary
+summary_reserve_fraction = 0.3  # or earlier by this fraction of the remaining time, if it is less than summary_reserve
+
+#########################################
+#  Section selection, between embedding search and answer generation
+#
+mmr_lambda = 0.7            # maximal marginal relevance, 1.0 is pure relevance, lower values favor diversity
+answer_sections = 4         # at most this many sections (completion calls) are queried for answers, in MMR order
+redundancy_threshold = 0.95 # sections with cosine similarity above this to a selected section are collapsed into it
+minmergeoverlap = 40        # in char, minimum overlap to merge adjacent sections from the same web page
 
 ############################################
 # OpenAI Rate Limit
@@ -45,6 +68,9 @@ completion_start_timer = time.time()
 
 progress_counter = 0
 rate_period = 10
+# rate limit counters are shared by concurrent calls
+embedding_rate_lock  = threading.Lock()
+completion_rate_lock = threading.Lock()
 
 def embedding_rate_limit_control(rate_period, curr_tokens):
     """
@@ -54,6 +80,10 @@ def embedding_rate_limit_control(rate_period, curr_tokens):
     :param rate_period:    the time period, in seconds, for the number of requests (limit)
     :param curr_tokens:   thenumber of tokens for current request
     """
+    with embedding_rate_lock:
+        _embedding_rate_limit_control(rate_period, curr_tokens)
+
+def _embedding_rate_limit_control(rate_period, curr_tokens):
     global embedding_token_limit
     global embedding_token_counter
     global embedding_start_timer
@@ -80,6 +110,10 @@ def completion_rate_limit_control(rate_period, curr_tokens):
     :param rate_period:    the time period, in seconds, for the number of requests (limit)
     :param curr_tokens:   thenumber of tokens for current request
     """
+    with completion_rate_lock:
+        _completion_rate_limit_control(rate_period, curr_tokens)
+
+def _completion_rate_limit_control(rate_period, curr_tokens):
     global completion_token_limit
     global completion_token_counter
     global completion_start_timer
@@ -99,10 +133,16 @@ def completion_rate_limit_control(rate_period, curr_tokens):
             completion_token_counter = curr_tokens
 
 def tokenCount(inputstr):
+    import tiktoken
     encodingFunc = tiktoken.get_encoding("cl100k_base")
     return len(encodingFunc.encode(inputstr))
 
-def get_embedded_dataframe(webs=[], searchphrase="", filename=""):
+def approxTokenCount(inputstr):
+    # about 4 chars per token for English text; for local backend, which runs without network,
+    # while tiktoken downloads its encoding on first use
+    return (len(inputstr) + 3) // 4
+
+def get_embedded_dataframe(webs=[], searchphrase="", filename="", numresults=8, searchprovider=bingSearchLinks, deadline=None):
     """
     From a user question, or a list of web URLs, retrieve web contents
     and then put into a dataframe, along with OpenAI embedding
@@ -110,6 +150,11 @@ def get_embedded_dataframe(webs=[], searchphrase="", filename=""):
     :param webs:    a list of web URLs; use either webs or userquestion, but not both
     :param searchphrase:   search phrase that would trigger Bing search to get a list of web URLs
     :param filename:   dataframe filename, as processed data store. If the file exists, the file content is returned.
+    :param numresults: number of search result web pages to load, result pages are searched concurrently
+    :param searchprovider:  search link provider, a function (searchphrase, numresults) -> a list of URLs
+    :param deadline:   time (as time.time()) to finish loading web pages, pages not loaded by then are skipped.
+                       the result is then partial, df.attrs["partial"] is True and df.attrs["skipped"] lists skipped pages,
+                       and it is stored as <name>-partial.csv, so it is not reused as a complete data store.
     :return:  a dataframe with OpenAI embedding:  columns=['webpage', 'subject', 'content', 'combined', 'embedding']
     """
     searchwebs = webs.copy()
@@ -120,13 +165,16 @@ def get_embedded_dataframe(webs=[], searchphrase="", filename=""):
     else:
         hashstr = getFilenameHash(webs, searchphrase)
         embeddingfilename = "/tmp/web-" + hashstr + ".csv"
+        if embedding_backend != "openai":
+            # embeddings from different backends are stored separately
+            embeddingfilename = "/tmp/web-" + hashstr + "-" + embedding_backend + ".csv"
 
     alreadyembedded = os.path.isfile(embeddingfilename)
     if alreadyembedded == False:
         if len(searchwebs) < 1:
             if  searchphrase != None and len(searchphrase) > 3:
                 # do bing search to get webs
-                searchwebs = getBingSearchLinks(searchphrase, numresults=8)
+                searchwebs = getSearchLinks(searchphrase, numresults=numresults, provider=searchprovider)
             else:
                 raise Exception("Cannot generate embedding, missing list of webs or user question.")
 
@@ -135,31 +183,118 @@ def get_embedded_dataframe(webs=[], searchphrase="", filename=""):
             return None
 
         log("Load " + str(len(searchwebs)) + " webpages, render and collect contents..." + (" " * 40), endstr="\r")
-        results = getAsyncWebResponses(searchwebs)
+        results = getAsyncWebResponses(searchwebs, deadline=deadline)
+        skipped = commonfuncs.fetch_skipped.copy()
+        if len(skipped) > 0:
+            log(f"Continue with {len(searchwebs) - len(skipped)} webpages, skipped {len(skipped)} at the deadline" + (" " * 20), endstr="\n")
+            embeddingfilename = os.path.splitext(embeddingfilename)[0] + "-partial.csv"
         df = extractWebContentsParallel(searchwebs, results, maxsectionlength, ignorelength, mincontentoverlap)
-        global start_timer
-        start_timer = time.time()
-        global progress_counter
-        progress_counter = 0
-        log("Start generating embeddings" + (" " * 20), endstr="\r")
-        df["embedding"] = df.combined.apply(lambda x: rate_limit_embeddings(x))
-        time.sleep(0.5)
-        #  count number of tokens, put into second column
-        #
-        # embedding model parameters
-        encoding = tiktoken.get_encoding(embedding_encoding)
-        df["n_tokens"] = df.combined.apply(lambda x: len(encoding.encode(x)))
-        time.sleep(1)
+        df = remove_duplicate_sections(df, embeddingfilename)
+        df = embed_sections(df, embeddingfilename)
         log("Finished embedding - hash=" + hashstr + (" " * 40))
         df.to_csv(embeddingfilename, sep="\t")
         time.sleep(2)
         outdf = pd.read_csv(embeddingfilename, sep="\t")
-        return outdf
+        outdf.attrs["partial"] = len(skipped) > 0
+        outdf.attrs["skipped"] = skipped
+        return load_embedding_store(outdf, embeddingfilename)
     else:
         log("Using cached embedding data - hash=" + hashstr + (" " * 20))
         outdf = pd.read_csv(embeddingfilename, sep="\t")
-        return outdf
+        return load_embedding_store(outdf, embeddingfilename)
+
+def embed_sections(df, embeddingfilename, backend=None):
+    """
+    embed sections of a dataframe, and count tokens.
+    with local backend or quantized storage, embeddings are saved as an embedding store next to the data store,
+    otherwise they are kept in 'embedding' column.
+
+    :param df:        dataframe from extractWebContentsParallel
+    :param embeddingfilename:  the data store filename
+    :param backend:   embedding backend, a key of embedding_backends, default embedding_backend
+    :return:  dataframe with 'n_tokens' column, and 'embedding' column for OpenAI embeddings stored as text
+    """
+    if backend == None:
+        backend = embedding_backend
+    backendfuncs = get_backend(backend)
+    global start_timer
+    start_timer = time.time()
+    global progress_counter
+    progress_counter = 0
+    log("Start generating embeddings" + (" " * 20), endstr="\r")
+    model, embeddings = backendfuncs["embed_corpus"](df.combined.tolist())
+    if backendfuncs["save"] is not None:
+        backendfuncs["save"](model, embeddingfilename)
+    #  count number of tokens, put into second column
+    df["n_tokens"] = df.combined.apply(backendfuncs["token_count"])
+    time.sleep(1)
+    if backendfuncs["text_storage"] and embedding_storage == "float32":
+        df["embedding"] = embeddings
+    else:
+        matrix = embedding_matrix(embeddings)
+        save_store(build_store(matrix, embedding_storage, backend), embeddingfilename, matrix)
+    return df
+
+corpus_stores = {}   # id(dataframe) -> (weak reference to dataframe, embedding store), dropped with the dataframe
+
+def register_embedding_store(df, store):
+    corpus_stores[id(df)] = (weakref.ref(df), store)
+    # free the store (codes, memory-mapped matrix, local model) when the dataframe is freed, such as an evicted shard
+    weakref.finalize(df, corpus_stores.pop, id(df), None)
+
+def load_embedding_store(df, embeddingfilename):
+    """
+    load the quantized embedding store saved with the data store, if any, and associate it with the dataframe
 
+    :param df:    dataframe loaded from the data store
+    :param embeddingfilename:  the data store filename
+    :return:  the dataframe
+    """
+    store = load_store(embeddingfilename)
+    if store is not None:
+        if len(store["codes"]) != len(df.index):
+            raise Exception(f"embedding store has {len(store['codes'])} rows, but {embeddingfilename} has {len(df.index)} rows")
+        backendfuncs = get_backend(store["backend"])
+        if backendfuncs["load"] is not None:
+            store["model"] = backendfuncs["load"](embeddingfilename)
+        register_embedding_store(df, store)
+    return df
+
+def get_embedding_store(df):
+    """
+    embedding store of a dataframe; for data stores with embeddings as text, a float32 store is built on first use.
+    store rows are aligned with dataframe rows, by position.
+
+    :param df:   dataframe from get_embedded_dataframe
+    :return:  the embedding store
+    """
+    entry = corpus_stores.get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    # embeddings are stored as text of a list of floats, parsed as JSON (much faster than eval)
+    store = build_store(embedding_matrix(df.embedding.apply(json.loads)), "float32")
+    register_embedding_store(df, store)
+    return store
+
+def remove_duplicate_sections(df, embeddingfilename):
+    """
+    drop duplicate sections (boilerplate, repeated paragraphs) across web pages before embedding.
+    dropped sections and the web pages sharing them are saved next to the embedding file, as <name>-dups.csv
+
+    :param df:    dataframe from extractWebContentsParallel
+    :param embeddingfilename:  the embedding data store filename
+    :return:  dataframe without duplicate sections
+    """
+    keptdf, dropdf = dedupeWebContents(df)
+    if dropdf is None or len(dropdf.index) == 0:
+        return keptdf
+
+    countfunc = get_backend(embedding_backend)["token_count"]
+    savedtokens = sum(countfunc(x) for x in dropdf.combined)
+    log(f"Dropped {len(dropdf.index)} duplicate sections (among {len(df.index)}), saved {savedtokens} embedding tokens" + (" " * 20), endstr="\n")
+    dupfilename = os.path.splitext(embeddingfilename)[0] + "-dups.csv"
+    dropdf.to_csv(dupfilename, sep="\t")
+    return keptdf
 
 def get_embedding_timeout(text: str, engine: str, timeout=10):
     """
@@ -169,6 +304,7 @@ def get_embedding_timeout(text: str, engine: str, timeout=10):
     :param timeout: request timeout, default 10
     :return: array of embedding codes
     """
+    import openai
     embedding = openai.Embedding.create(
         input=text, model=engine, request_timeout=timeout
     )["data"][0]["embedding"]
@@ -197,41 +333,214 @@ def rate_limit_embeddings(text, model=embedding_model):
         log(f"Embed first 10k char (for long text), ignore text from: {text[10001:10080]}..", endstr="\n", outfile=sys.stdout)
         return get_embedding_timeout(text[:10000], embedding_model)
 
+def openai_embed_corpus(texts):
+    embeddings = [rate_limit_embeddings(x) for x in texts]
+    time.sleep(0.5)
+    return None, embeddings
+
+def openai_embed_queries(model, texts, timeout=10):
+    if len(texts) == 1:
+        curr_tokens_num = tokenCount(texts[0])
+        embedding_rate_limit_control(rate_period, curr_tokens_num)
+        return [get_embedding_timeout(texts[0], embedding_model, timeout)]
+    return get_embeddings_batch(texts, timeout=max(timeout, 30))
+
+def local_embed_corpus(texts):
+    return fit_local_model(texts, local_embedding_dims)
+
+def local_embed_queries(model, texts, timeout=10):
+    return list(local_embed(model, texts))
+
+#########################################
+#  Embedding backends, by name:
+#     embed_corpus(texts) -> (model or None, embeddings), embed_queries(model, texts, timeout) -> embeddings
+#     save(model, embeddingfilename) and load(embeddingfilename) -> model, for a model fitted on the corpus, or None
+#     token_count(text) -> number of tokens, threshold - only sections with higher similarity are used for answers
+#     text_storage - with float32 storage, embeddings are kept as text in 'embedding' column of the data store
+#
+embedding_backends = {
+    "openai": {"embed_corpus": openai_embed_corpus, "embed_queries": openai_embed_queries, "save": None, "load": None,
+               "token_count": tokenCount, "threshold": 0.8, "text_storage": True},
+    "local":  {"embed_corpus": local_embed_corpus, "embed_queries": local_embed_queries,
+               "save": save_local_model, "load": load_local_model,
+               "token_count": approxTokenCount, "threshold": 0.5, "text_storage": False},
+}
+
+def get_backend(backend):
+    if backend not in embedding_backends:
+        raise Exception(f"unknown embedding backend {backend}, should be one of {list(embedding_backends.keys())}")
+    return embedding_backends[backend]
+
+def relevance_threshold(store):
+    """
+    :return:  similarity threshold for sections used for answers, by the backend of the embedding store
+    """
+    return get_backend(store["backend"])["threshold"]
+
+def embed_queries(store, texts, timeout=10):
+    """
+    embed questions with the same backend as the embedding store, so vectors from different backends are never mixed
+
+    :param store:   the embedding store
+    :param texts:   a list of questions
+    :param timeout: request timeout, in seconds
+    :return:  a list of embeddings
+    """
+    return get_backend(store["backend"])["embed_queries"](store.get("model"), texts, timeout)
+
 # given input_text, search through DataFrame to find top_n similarity entries,
 # return dataframe of [webpage, content, n_tokens, similarity]
-def search_embedding(df, input_text, top_n=5):
+def search_embedding(df, input_text, top_n=5, deadline=None):
     # generate embeddings for input text
-    curr_tokens_num = tokenCount(input_text)
-    embedding_rate_limit_control(rate_period, curr_tokens_num)
-    searchword = get_embedding_timeout(
-        input_text,
-        embedding_model
-    )
-
-    #### compare inputed embedding with combined embeddeing, get consine similarity
-    df["similarity"] = df.nparray.apply(lambda x: cosine_similarity(x, searchword))
-
-    ####  sort similarity by decending, return top n most irrelevant results
-    sdf = df.sort_values(by="similarity", ascending=False)
-    psdf = sdf[["webpage", "similarity", "subject", "content", "n_tokens"]].head(top_n)
+    store = get_embedding_store(df)
+    searchword = embed_queries(store, [input_text], max(1.0, remainingTime(deadline, 10)))[0]
+
+    #### compare inputed embedding with stored embeddings, get cosine similarity, top n most relevant results
+    positions, similarities = store_topn(store, searchword, top_n, rescore_n=top_n * rescore_factor)
+    psdf = df.iloc[positions][["webpage", "subject", "content", "n_tokens"]].copy()
+    psdf.insert(1, "similarity", similarities)
     return psdf
 
+def merge_overlap(firststr, secondstr, minoverlap=minmergeoverlap):
+    """
+    merge two adjacent contents broken up by splitstring, the tail of first string overlaps the head of second string.
+
+    :param firststr:   the preceding content
+    :param secondstr:  the following content
+    :param minoverlap: minimum overlap length (in char) to be considered as adjacent contents
+    :return:  merged string, or None if the two strings do not overlap
+    """
+    if len(firststr) < minoverlap or len(secondstr) < minoverlap:
+        return None
+    probe = secondstr[:minoverlap]
+    pos = firststr.find(probe)
+    while pos >= 0:
+        tailstr = firststr[pos:]
+        if secondstr.startswith(tailstr):
+            return firststr[:pos] + secondstr
+        pos = firststr.find(probe, pos + 1)
+    return None
+
+def most_similar_section(idx, selected, vectors):
+    """
+    :return:  (max cosine similarity of section idx to selected sections, index of the most similar selected section)
+    """
+    maxsim = 0.0
+    dupof = None
+    for sidx in selected:
+        if len(vectors[idx]) != len(vectors[sidx]):
+            continue    # embeddings from different backends are not comparable
+        sim = cosine_similarity(vectors[idx], vectors[sidx])
+        if sim > maxsim:
+            maxsim = sim
+            dupof = sidx
+    return maxsim, dupof
+
+def select_sections(df, topdf, lambda_mult=mmr_lambda, dupthreshold=redundancy_threshold, max_tokens=maxprompttokens, vectors=None,
+                    max_sections=answer_sections, relevance="similarity"):
+    """
+    select sections to query for answers, among top search results, with maximal marginal relevance (MMR):
+    sections are picked one by one, by relevance minus similarity to sections already picked, up to max_sections.
+    the rest of search results are not queried.  near-duplicate sections (overlapped chunks, or same text on sibling pages),
+    selected or not, are collapsed into the selected section,
+    adjacent overlapping chunks from the same web page are merged into one section.
+    all web pages of collapsed or merged sections are kept in 'sources' column, for references.
+
+    :param df:          the full dataframe, with embedding store
+    :param topdf:       top search results from search_embedding, index aligned with df
+    :param lambda_mult: MMR trade-off between relevance (1.0) and diversity (0.0)
+    :param dupthreshold: sections with cosine similarity above this to a selected section are considered duplicates
+    :param max_tokens:  merged section should not exceed this number of tokens
+    :param vectors:     embeddings of topdf rows, dictionary of topdf index -> embedding; default from df embedding store
+    :param max_sections: maximum number of sections selected, before merging adjacent sections
+    :param relevance:   topdf column of relevance for MMR, such as 'score' (weighted similarity) of multi-corpus results
+    :return:  dataframe of [webpage, similarity, subject, content, n_tokens, sources], in MMR order,
+              at most max_sections rows
+    """
+    if len(topdf.index) < 2:
+        outdf = topdf.copy()
+        outdf["sources"] = outdf.webpage.apply(lambda x: [x])
+        return outdf
+
+    candidates = list(topdf.index)
+    if vectors == None:
+        candvectors = store_vectors(get_embedding_store(df), df.index.get_indexer(candidates))
+        vectors = {idx: candvectors[i] for i, idx in enumerate(candidates)}
+    selected = []
+    sources = {}
+    while len(candidates) > 0 and len(selected) < max_sections:
+        bestidx = None
+        bestscore = None
+        bestdup = None
+        for idx in candidates:
+            maxsim, dupof = most_similar_section(idx, selected, vectors)
+            score = lambda_mult * topdf.at[idx, relevance] - (1 - lambda_mult) * maxsim
+            if bestscore is None or score > bestscore:
+                bestidx = idx
+                bestscore = score
+                bestdup = dupof if maxsim >= dupthreshold else None
+        candidates.remove(bestidx)
+        if bestdup is not None:
+            # redundant section, only keep its web page for references
+            if topdf.at[bestidx, "webpage"] not in sources[bestdup]:
+                sources[bestdup].append(topdf.at[bestidx, "webpage"])
+            continue
+        selected.append(bestidx)
+        sources[bestidx] = [topdf.at[bestidx, "webpage"]]
+    # near-duplicates are scored last by MMR, credit their web pages even if not reached within max_sections
+    for idx in candidates:
+        maxsim, dupof = most_similar_section(idx, selected, vectors)
+        if maxsim >= dupthreshold and topdf.at[idx, "webpage"] not in sources[dupof]:
+            sources[dupof].append(topdf.at[idx, "webpage"])
+
+    # merge adjacent chunks of the same web page section, in original (document) order
+    rows = []
+    for idx in sorted(selected):
+        row = topdf.loc[idx].to_dict()
+        row["sources"] = sources[idx]
+        row["lastidx"] = idx
+        row["mmrrank"] = selected.index(idx)
+        if len(rows) > 0:
+            prev = rows[-1]
+            if prev["lastidx"] == idx - 1 and prev["webpage"] == row["webpage"] and prev["subject"] == row["subject"] \
+                    and prev["n_tokens"] + row["n_tokens"] <= max_tokens:
+                merged = merge_overlap(prev["content"], row["content"])
+                if merged is not None:
+                    prev["content"] = merged
+                    prev["n_tokens"] = prev["n_tokens"] + row["n_tokens"]
+                    prev["similarity"] = max(prev["similarity"], row["similarity"])
+                    prev["lastidx"] = idx
+                    prev["mmrrank"] = min(prev["mmrrank"], row["mmrrank"])
+                    for src in row["sources"]:
+                        if src not in prev["sources"]:
+                            prev["sources"].append(src)
+                    continue
+        rows.append(row)
+
+    rows.sort(key=lambda x: x["mmrrank"])
+    outdf = pd.DataFrame(rows, columns=["webpage", "similarity", "subject", "content", "n_tokens", "sources"])
+    log(f"selected {len(outdf.index)} sections from {len(topdf.index)} search results, by MMR      ", endstr="\r")
+    return outdf
+
 userq=""
-def search_for_answer(row):
+def search_for_answer(row, question=None, deadline=None):
     global userq
     global progress_counter
+    if question == None:
+        question = userq
     promptmsg=[
         {"role": "system", "content": "Answer with Context. If the answer is not in Context, answer 'i do not know.'."},
         {"role": "system", "content": "Context : " + row["content"]},
-        {"role": "user", "content": userq}
+        {"role": "user", "content": question}
     ]
     log("Query "+ lang_model + " " + str(row["n_tokens"]) + " tokens; Context: \033[1m" + row["content"][:60] + "\033[m" + ("." * (progress_counter * 2)),
         endstr="\r")
     response = None
     prompt_tokens = tokenCount(json.dumps(promptmsg))
+    import openai
 
     c = 0;
-    while (response == None) and (c < 3):
+    while (response == None) and (c < 3) and remainingTime(deadline, 1) > 0:
         try:
             completion_rate_limit_control(rate_period, prompt_tokens);
             response = openai.ChatCompletion.create(
@@ -240,13 +549,13 @@ def search_for_answer(row):
                 temperature=0.0,
                 max_tokens=maxcompletiontokens,
                 n=1,
-                request_timeout=40
+                request_timeout=max(1.0, remainingTime(deadline, 40))
             )
         except Exception as ex:
             c = c + 1
             log(f" failed to query {lang_model} with {ex}; sleep {(c * 5)} seconds and do again", endstr="\n")
             traceback.print_stack(limit=6, file=sys.stderr)
-            time.sleep(c * 5)
+            time.sleep(remainingTime(deadline, c * 5))
             response = None
     progress_counter +=1
     if response == None:
@@ -276,6 +585,7 @@ def summarize_answer(userq, syspromptstr, timeout=40):
             {"role": "user", "content": userq}
         ]
     try:
+        import openai
         completion_rate_limit_control(rate_period, num_tokens);
         response = openai.ChatCompletion.create(
             model=lang_model,
@@ -291,41 +601,195 @@ def summarize_answer(userq, syspromptstr, timeout=40):
         return "ERROR "
     return prefixstr + response.choices[0].message["content"]
 
-def get_answer(df, userq, top_n=6):
+def get_answer(df, userq, top_n=6, deadline=None):
+    """
+    answer a question from the dataframe
+
+    :param df:       dataframe from get_embedded_dataframe
+    :param userq:    user question
+    :param top_n:    number of top sections to generate answers
+    :param deadline: time (as time.time()) to answer, pending section answers are cancelled before the deadline,
+                     and the answer is summarized from the section answers already received.
+    :return:  answer object {"answer", "references", "partial", "skipped"},
+              partial is True if web pages (from get_embedded_dataframe) or sections were skipped for the deadline,
+              skipped lists web pages not loaded, or with cancelled sections and not in references
+    """
     global progress_counter
     progress_counter = 1
 
-    parallel_num=2
-    if os.cpu_count() > 2:
-        parallel_num = os.cpu_count() - 1
-    pandarallel.initialize(progress_bar=False, nb_workers=parallel_num, verbose=0)
-
-    # add numpy array in df, for math
-    df["nparray"] = df.embedding.apply(eval).apply(np.array)
-
     log(f"search embedding ... {userq=}            ", endstr="\r")
-    topdf = search_embedding(df, userq, top_n)
-    topgooddf = topdf.loc[topdf["similarity"] >= 0.8 ]   # only use high similarity items
+    topdf = search_embedding(df, userq, top_n, deadline)
+    topgooddf = topdf.loc[topdf["similarity"] >= relevance_threshold(get_embedding_store(df)) ]   # only use high similarity items
     if len(topgooddf.index) > 0:
         log("selected " + str(len(topgooddf.index)) + " (among " + str(len(df.index)) + ") most relevant sections to generate answers...", endstr="\r")
     else:
         log("no relevant data from your materials, use OpenAI to generate answers...")
 
+    selecteddf = None
+    if len(topgooddf.index) > 0:
+        selecteddf = select_sections(df, topgooddf)
+    answerobj = answer_with_sections(userq, selecteddf, deadline)
+    for aweb in df.attrs.get("skipped", []):
+        if aweb not in answerobj["skipped"]:
+            answerobj["skipped"].append(aweb)
+    answerobj["partial"] = answerobj["partial"] or df.attrs.get("partial", False)
+    return answerobj
+
+def answer_with_sections(userq, selecteddf, deadline=None):
+    """
+    query each selected section for answers, concurrently, and summarize them as the final answer
+
+    :param userq:        user question
+    :param selecteddf:   selected sections from select_sections, or None if there are no relevant sections
+    :param deadline:     time (as time.time()) to answer, section answers still pending when summary_reserve seconds
+                         (or summary_reserve_fraction of the remaining time, if less) are left, are cancelled
+    :return:  answer object {"answer", "references", "partial", "skipped"}, partial is True if any section is cancelled,
+              skipped lists web pages of cancelled sections, except web pages already in references
+    """
     resultstr = ""
     refs = []
-    if len(topgooddf.index) > 0:
-        answerdf = topgooddf.apply(search_for_answer, axis=1)
-        for index,value in answerdf.items():
-            pair = value.split("===>")
-            dstr = pair[1]
-            if dstr[:13] != "I do not know":
-                resultstr = resultstr + dstr + " "
-                if pair[0] not in refs:
-                    refs.append(pair[0])
-    log(f'calling sumarize with:  {resultstr[:60]}....            ', endstr="\r")
-    fanswer = summarize_answer(userq, resultstr)
-
-    answerobj = {"answer": fanswer, "references": refs}
+    skipped = []
+    numcancelled = 0
+    if selecteddf is not None and len(selecteddf.index) > 0:
+        executor = cf.ThreadPoolExecutor(max_workers=answer_workers)
+        futures = [executor.submit(search_for_answer, row, userq, deadline) for row in selecteddf.to_dict("records")]
+        answerdeadline = None
+        if deadline != None:
+            answerdeadline = deadline - min(summary_reserve, summary_reserve_fraction * remainingTime(deadline, float("inf")))
+        done, pending = cf.wait(futures, timeout=None if deadline == None else remainingTime(answerdeadline, float("inf")))
+        # do not wait for pending answers, running requests are abandoned
+        executor.shutdown(wait=False, cancel_futures=True)
+        answered = [i for i, af in enumerate(futures) if af in done]
+        numcancelled = len(futures) - len(answered)
+        if numcancelled > 0:
+            log(f"Cancelled {numcancelled} pending section answers at the deadline" + (" " * 20), endstr="\n")
+        resultstr, refs = combine_answers(selecteddf.iloc[answered], [futures[i].result() for i in answered])
+        for i, af in enumerate(futures):
+            if af not in done:
+                for aweb in selecteddf["sources"].iloc[i]:
+                    if aweb not in skipped and aweb not in refs:
+                        skipped.append(aweb)
+    if numcancelled > 0 and len(resultstr.strip()) == 0:
+        # not a question without relevant materials, do not answer without context
+        fanswer = f"Ran out of time before any of {numcancelled} relevant sections was answered, please try again with more time."
+    else:
+        log(f'calling sumarize with:  {resultstr[:60]}....            ', endstr="\r")
+        fanswer = summarize_answer(userq, resultstr, timeout=max(1.0, remainingTime(deadline, 40)))
+
+    answerobj = {"answer": fanswer, "references": refs, "partial": numcancelled > 0, "skipped": skipped}
     return answerobj
 
+def combine_answers(selecteddf, answers):
+    """
+    combine answers from sections, skip sections without answer
+
+    :param selecteddf:  selected sections, from select_sections
+    :param answers:     answers from search_for_answer, in the same order as selecteddf
+    :return:  (combined answers string, list of references)
+    """
+    resultstr = ""
+    refs = []
+    for sources, value in zip(selecteddf["sources"], answers):
+        pair = value.split("===>")
+        dstr = pair[1]
+        if dstr[:13] != "I do not know":
+            resultstr = resultstr + dstr + " "
+            for aref in sources:
+                if aref not in refs:
+                    refs.append(aref)
+    return resultstr, refs
+
+def get_embeddings_batch(texts, model=embedding_model, timeout=30):
+    """
+    embed a list of texts, in as few requests as the rate limit allows
+
+    :param texts:    a list of texts
+    :param model:    embedding model
+    :param timeout:  request timeout, for each request
+    :return:  a list of embeddings, in the same order as texts
+    """
+    import openai
+    embeddings = []
+    batch = []
+    batchtokens = 0
+    for atext in texts + [None]:
+        numtokens = 0 if atext == None else tokenCount(atext)
+        if len(batch) > 0 and (atext == None or len(batch) >= 2048 or batchtokens + numtokens > embedding_token_limit):
+            embedding_rate_limit_control(rate_period, batchtokens)
+            response = openai.Embedding.create(input=batch, model=model, request_timeout=timeout)
+            embeddings += [item["embedding"] for item in sorted(response["data"], key=lambda x: x["index"])]
+            batch = []
+            batchtokens = 0
+        if atext != None:
+            batch.append(atext)
+            batchtokens += numtokens
+    return embeddings
+
+def get_answers_batch(df, questions, top_n=6, outfile=sys.stdout, num_workers=8):
+    """
+    answer many questions against one dataframe.  questions are embedded in one batch and scored with one matrix product,
+    questions differing only in case, spaces or punctuation are answered once, and completions run concurrently
+    under the rate limit.
+    each result is written to outfile as a JSON line when its question is answered, in completion order:
+        {"question", "answer", "references", "timing": {"search", "answer", "total"}}  (timing in seconds)
+
+    :param df:          dataframe from get_embedded_dataframe
+    :param questions:   a list of questions
+    :param top_n:       number of top search results for each question
+    :param outfile:     output file for JSON lines, default sys.stdout
+    :param num_workers: number of concurrent completion calls
+    :return:  a list of answer objects, in the same order as questions
+    """
+    if len(questions) == 0:
+        return []
+    batchstart = time.time()
+    # questions with typing variances (case, extra space, punctuation) are answered once
+    uniqueqs = {}
+    for aquestion in questions:
+        uniqueqs.setdefault(canonicalize(aquestion), aquestion)
+    canonicals = list(uniqueqs.keys())
+
+    log(f"embed {len(canonicals)} questions (among {len(questions)}) ...            ", endstr="\r")
+    store = get_embedding_store(df)
+    qembeddings = embed_queries(store, [uniqueqs[c] for c in canonicals])
+    simmatrix = store_similarity(store, qembeddings)
+    searchtime = time.time() - batchstart
+
+    selected = {}           # canonical question -> (selected sections, list of futures)
+    with cf.ThreadPoolExecutor(max_workers=num_workers) as sectionexecutor, \
+            cf.ThreadPoolExecutor(max_workers=num_workers) as summaryexecutor:
+        for j, cq in enumerate(canonicals):
+            positions, similarities = store_topn(store, qembeddings[j], top_n, rescore_n=top_n * rescore_factor, sims=simmatrix[:, j])
+            topdf = df.iloc[positions][["webpage", "subject", "content", "n_tokens"]].copy()
+            topdf.insert(1, "similarity", similarities)
+            topgooddf = topdf.loc[topdf["similarity"] >= relevance_threshold(store) ]   # only use high similarity items
+            selecteddf = select_sections(df, topgooddf) if len(topgooddf.index) > 0 else topgooddf
+            futures = [sectionexecutor.submit(search_for_answer, arow, uniqueqs[cq]) for arow in selecteddf.to_dict("records")]
+            selected[cq] = (selecteddf, futures)
+
+        def answer_question(cq):
+            answerstart = time.time()
+            selecteddf, futures = selected[cq]
+            resultstr = ""
+            refs = []
+            if len(futures) > 0:
+                resultstr, refs = combine_answers(selecteddf, [f.result() for f in futures])
+            fanswer = summarize_answer(uniqueqs[cq], resultstr)
+            return {"answer": fanswer, "references": refs,
+                    "timing": {"search": round(searchtime, 3), "answer": round(time.time() - answerstart, 3)}}
+
+        summaryfutures = {summaryexecutor.submit(answer_question, cq): cq for cq in canonicals}
+        answers = {}
+        for af in cf.as_completed(summaryfutures):
+            cq = summaryfutures[af]
+            answerobj = af.result()
+            answerobj["timing"]["total"] = round(time.time() - batchstart, 3)
+            answers[cq] = answerobj
+            for aquestion in questions:
+                if canonicalize(aquestion) == cq:
+                    print(json.dumps({"question": aquestion, **answerobj}), file=outfile, flush=True)
+
+    log(f"answered {len(questions)} questions in {time.time() - batchstart:.1f} seconds            ", endstr="\n")
+    return [answers[canonicalize(aquestion)] for aquestion in questions]
+
 
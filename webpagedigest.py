@@ -3,14 +3,14 @@
 #
 #  package installed: 
 #     /usr/local/bin/python3 -m pip install py-pdf-parser beautifulsoup4
+#  parsers are imported when used, cached corpus does not need them.
 #
 import os
 
-from py_pdf_parser.loaders import load_file
 import pandas as pd
-from bs4 import BeautifulSoup
-from commonfuncs import log, getAsyncWebResponses
-import sys, traceback, urllib.parse, os, threading
+import numpy as np
+from commonfuncs import log, getAsyncWebResponses, canonicalize, getFilenameHash
+import sys, traceback, urllib.parse, os, threading, random, zlib, hashlib, json, time
 import concurrent.futures as cf
 
 def updateHeaderRow(df, sizenum, lengthnum):
@@ -169,6 +169,7 @@ def parsepdf(df, weburl, pdffile, maxcontentlength, ignorelength, mincontentover
     :param mincontentoverlap: requires minimum # of chars overlap when breaking up contents
     :return:    updated dataframe with this PDF file:  DataFrame(None, columns=['webpage', 'subject', 'content', 'combined'])
     """
+    from py_pdf_parser.loaders import load_file
     pdfdoc = load_file(pdffile)
     headerdf = buildPdfHeaderMapping(pdfdoc, headermaxlen=200, ignorelen=10, ignorecombinedlen=ignorelength)
     h1 = ''
@@ -229,6 +230,7 @@ def parsehtml(df, weburl, htmltext, maxcontentlength, ignorelength, mincontentov
     h2str=''
     h3str=''
     contentstr=''
+    from bs4 import BeautifulSoup
     s = BeautifulSoup(htmltext, 'html.parser')
     currelem = s.find('h1')
     if currelem != None and currelem.string != None:
@@ -280,6 +282,65 @@ def parsehtml(df, weburl, htmltext, maxcontentlength, ignorelength, mincontentov
     df = addrows(df, weburl, key, contentstr, maxcontentlength, ignorelength, mincontentoverlap)
     return(df)
 
+skiptags = ['script', 'style', 'svg', 'meta']
+headertags = ['h1', 'h2', 'h3']
+
+def parsehtmlsinglepass(df, weburl, htmltext, maxcontentlength, ignorelength, mincontentoverlap):
+    """
+    parse HTML into sections of h1|h2|h3 headers, same as parsehtml, but walk the document once:
+    each text node is added once to its current section, script|style|svg|meta subtrees are not visited.
+    text before the first h1 is ignored; if there is no h1, all text (including h2|h3 headers) is one section.
+
+    :param df:    dataframe to add rows to
+    :param weburl:  web url
+    :param htmltext:  HTML contents
+    :param maxcontentlength:  max # of chars, longer contents will be broken into multiple
+    :param ignorelength:      ignore short content, in chars
+    :param mincontentoverlap: requires minimum # of chars overlap when breaking up contents
+    :return:  dataframe with added rows
+    """
+    from bs4 import BeautifulSoup, Tag, NavigableString
+    from bs4.element import PreformattedString
+    s = BeautifulSoup(htmltext, 'html.parser')
+    headers = {'h1': '', 'h2': '', 'h3': ''}
+    foundh1 = False
+    contentparts = []
+    # depth-first walk in document order, a stack of children iterators instead of recursion
+    stack = [iter(s.contents)]
+    while len(stack) > 0:
+        currelem = next(stack[-1], None)
+        if currelem == None:
+            stack.pop()
+        elif isinstance(currelem, Tag):
+            if currelem.name in skiptags:
+                continue
+            # before the first h1, h2|h3 headers are walked as content, a page may have no h1
+            elif currelem.name == 'h1' or (foundh1 and currelem.name in headertags):
+                if foundh1:
+                    # save h1|h2|h3 contents so far
+                    key = headers['h1'] + " - " + headers['h2'] + " - " + headers['h3']
+                    df = addrows(df, weburl, key, " ".join(contentparts), maxcontentlength, ignorelength, mincontentoverlap)
+                contentparts = []
+                if currelem.name == 'h1':
+                    foundh1 = True
+                    headers['h2'] = ''
+                    headers['h3'] = ''
+                elif currelem.name == 'h2':
+                    headers['h3'] = ''
+                headers[currelem.name] = " ".join(currelem.get_text(" ").split())
+            else:
+                stack.append(iter(currelem.contents))
+        elif isinstance(currelem, NavigableString) and not isinstance(currelem, PreformattedString):
+            # comments, CDATA, doctype and other preformatted strings are not content
+            textstr = " ".join(currelem.split())
+            if len(textstr) > 0:
+                contentparts.append(textstr)
+
+    #  write last section of this webpage, or the entire page without h1
+    key = headers['h1'] + " - " + headers['h2'] + " - " + headers['h3']
+    df = addrows(df, weburl, key, " ".join(contentparts), maxcontentlength, ignorelength, mincontentoverlap)
+    return(df)
+
 def parseWebContent(webpage, aresponse, df, maxcontentlength=8000, ignorelength=30, mincontentoverlap=800):
     """
     given a list of web URLs and a list of Response object, extract contents and put into dataframe
@@ -299,14 +360,21 @@ def parseWebContent(webpage, aresponse, df, maxcontentlength=8000, ignorelength=
         ct = aresponse.headers['Content-Type']
         if 'text/html' in ct.lower():
             htmltext = aresponse.html.html
-            df = parsehtml(df, webpage, htmltext, maxcontentlength, ignorelength, mincontentoverlap)
+            df = parsehtmlsinglepass(df, webpage, htmltext, maxcontentlength, ignorelength, mincontentoverlap)
             log(f"{threading.current_thread().name} Done parsing {webpage[:80]} .         ", endstr="\n")
         elif 'application/pdf' in ct.lower():
-            pdffilename = '/tmp/web' + str(hash(webpage))+'.pdf'
-            pdffile = open(pdffilename, 'wb')
-            pdffile.write(aresponse.content)
-            pdffile.close()
-            df = parsepdf(df, webpage, pdffilename, maxcontentlength, ignorelength, mincontentoverlap)
+            pdffilename = getattr(aresponse, 'bodyfile', None)
+            if pdffilename == None:
+                pdffilename = '/tmp/web' + str(hash(webpage))+'.pdf'
+                pdffile = open(pdffilename, 'wb')
+                pdffile.write(aresponse.content)
+                pdffile.close()
+            try:
+                df = parsepdf(df, webpage, pdffilename, maxcontentlength, ignorelength, mincontentoverlap)
+            finally:
+                if getattr(aresponse, 'bodyfile', None) != None:
+                    # PDF body streamed to a temp file by the fetch scheduler
+                    os.remove(pdffilename)
             log(f"{threading.current_thread().name} Done parsing {webpage[:80]} .         ", endstr="\n")
         else:
             log(f"Skip page {webpage[:80]} with unknown content type {ct}   \n", outfile=sys.stderr)
@@ -401,48 +469,245 @@ def extractWebContentsParallel(webs, responses, maxcontentlength=8000, ignorelen
         traceback.print_exc(limit=8, file=sys.stderr, chain=True)
     return None
 
+#  MinHash parameters, for near-duplicate detection among sections
+minhash_prime = 4294967311    # smallest prime above 2^32, crc32 shingle hashes are 32-bit
+minhash_rand = random.Random(20230923)   # fixed seed, signatures are comparable across executions
+minhash_coeffs = [(minhash_rand.randint(1, minhash_prime - 1), minhash_rand.randint(0, minhash_prime - 1)) for i in range(128)]
+# coefficient a is split into 16-bit high and low parts, so (a * x) % prime is computed in uint64 without overflow
+minhash_ahigh = np.array([a >> 16 for (a, b) in minhash_coeffs], dtype=np.uint64)[:, None]
+minhash_alow = np.array([a & 0xFFFF for (a, b) in minhash_coeffs], dtype=np.uint64)[:, None]
+minhash_b = np.array([b for (a, b) in minhash_coeffs], dtype=np.uint64)[:, None]
 
-def getBingSearchLinks(searchphrase, numresults=10):
+def shingleSet(contentstr, shinglesize=5):
     """
-    Search BING with a search phrase, return a list of URLs.
+    break content into overlapping word sequences (shingles), hashed to 32-bit integers.
+    words are canonicalized, so punctuation and case variances are ignored.
+
+    :param contentstr:  the content
+    :param shinglesize: number of words in a shingle
+    :return:  a set of hashed shingles
+    """
+    words = [canonicalize(w) for w in contentstr.split()]
+    words = [w for w in words if len(w) > 0]
+    if len(words) <= shinglesize:
+        return {zlib.crc32(" ".join(words).encode('utf-8'))}
+    return {zlib.crc32(" ".join(words[i:i+shinglesize]).encode('utf-8')) for i in range(len(words) - shinglesize + 1)}
+
+def minhashSignature(shingles, numperm=64):
+    """
+    MinHash signature of a shingle set, the fraction of equal positions between two signatures
+    estimates Jaccard similarity of the two sets.
+
+    :param shingles:  a set of hashed shingles
+    :param numperm:   number of hash permutations, at most 128
+    :return:  a tuple of numperm integers
+    """
+    x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    # (a * x + b) % prime for all permutations and shingles at once, each term is below 2^50
+    hashes = ((minhash_ahigh[:numperm] * x) % np.uint64(minhash_prime) << np.uint64(16)) \
+             + minhash_alow[:numperm] * x + minhash_b[:numperm]
+    return tuple((hashes % np.uint64(minhash_prime)).min(axis=1).tolist())
+
+def jaccard(set1, set2):
+    if len(set1) == 0 or len(set2) == 0:
+        return 0.0
+    return len(set1 & set2) / len(set1 | set2)
+
+def dedupeWebContents(df, threshold=0.8, shinglesize=5, numperm=64, bands=16):
+    """
+    detect exact and near-duplicate sections across all web pages, such as site-wide navigation, banners and footers,
+    or the same paragraphs on sibling pages.  only the first occurrence is kept, so duplicates are not embedded again.
+    candidates are found with MinHash and locality sensitive hashing (LSH) bands, then verified with Jaccard similarity.
+
+    :param df:          dataframe from extractWebContents, columns=['webpage', 'subject', 'content', 'combined']
+    :param threshold:   minimum Jaccard similarity of shingles to be considered duplicate
+    :param shinglesize: number of words in a shingle
+    :param numperm:     number of MinHash permutations
+    :param bands:       number of LSH bands, numperm should be divisible by bands
+    :return:  (kept dataframe, dropped dataframe) -- dropped dataframe has columns
+              ['webpage', 'subject', 'content', 'combined', 'kept_index', 'shared_webpages'],
+              kept_index is the index of the kept row, shared_webpages are all web pages sharing this block
+    """
+    dropcolumns = ['webpage', 'subject', 'content', 'combined', 'kept_index', 'shared_webpages']
+    if df is None or len(df.index) < 2:
+        return df, pd.DataFrame(None, columns=dropcolumns)
+
+    rows = numperm // bands
+    exacthashes = {}     # content digest -> kept index
+    buckets = {}         # (band no, band signature) -> list of kept indexes
+    shinglesets = {}     # kept index -> shingle set
+    sharedpages = {}     # kept index -> web pages sharing the same block
+    dropped = []
+    dropindexes = []
+    for idx in df.index:
+        webpage = df.at[idx, 'webpage']
+        contentstr = df.at[idx, 'content']
+        digest = hashlib.sha1(canonicalize(contentstr).encode('utf-8')).hexdigest()
+        keptidx = exacthashes.get(digest)
+
+        shingles = None
+        bandkeys = []
+        if keptidx is None:
+            shingles = shingleSet(contentstr, shinglesize)
+            signature = minhashSignature(shingles, numperm)
+            bandkeys = [(b, signature[b*rows:(b+1)*rows]) for b in range(bands)]
+            checked = set()
+            for bandkey in bandkeys:
+                for candidx in buckets.get(bandkey, []):
+                    if candidx in checked:
+                        continue
+                    checked.add(candidx)
+                    if jaccard(shingles, shinglesets[candidx]) >= threshold:
+                        keptidx = candidx
+                        break
+                if keptidx is not None:
+                    break
+
+        if keptidx is not None:
+            if webpage not in sharedpages[keptidx]:
+                sharedpages[keptidx].append(webpage)
+            dropped.append([webpage, df.at[idx, 'subject'], contentstr, df.at[idx, 'combined'], keptidx, sharedpages[keptidx]])
+            dropindexes.append(idx)
+            continue
+
+        exacthashes[digest] = idx
+        shinglesets[idx] = shingles
+        sharedpages[idx] = [webpage]
+        for bandkey in bandkeys:
+            buckets.setdefault(bandkey, []).append(idx)
+
+    dropdf = pd.DataFrame(dropped, columns=dropcolumns)
+    keptdf = df.drop(index=dropindexes)
+    return keptdf, dropdf
+
+search_cache_ttl = 24 * 3600     # in seconds, cached search links expire after a day
+
+def parseBingResults(contents):
+    """
+    Parse a Bing search result page, in one pass, return a list of URLs.
     Ignore ads, and other URLs, just the main page URLs from Bing algorithm
 
-    :param searchphrase:  the search query to Bing
-    :param numresults:   the number of URLs returned, default 10 - first Bing page
+    :param contents:   Bing search result page, in HTML
     :return:  a list of URLs in string format
     """
+    from bs4 import BeautifulSoup
+    webs = []
+    bcontent = BeautifulSoup(contents, 'html.parser').find("div", id="b_content")
+    if bcontent == None:
+        return webs
+    # carefully skip Ads and other non-essential materials
+    for b_algo in bcontent.find_all("li", class_="b_algo"):
+        #  find first <a> tag with href and starts with https://, skip positional or javascript <a> tag
+        for a_tag in b_algo.find_all('a', href=True):
+            bhref = a_tag.get("href")
+            if bhref.lower().startswith('https://'):
+                log(f'  a valid search result url {bhref[:60]}        ', endstr='\r')
+                webs.append(str(bhref))
+                break
+    return webs
+
+def bingSearchLinks(searchphrase, numresults=10):
+    """
+    Search link provider with Bing, result pages (10 results each) are retrieved concurrently, without JS rendering.
 
+    :param searchphrase:  the search query to Bing
+    :param numresults:   the number of URLs returned
+    :return:  a list of URLs in string format
+    """
     qstr=urllib.parse.quote(searchphrase, safe='')
-    srch1 = "https://www.bing.com/search?q=" + qstr + "&rdr=1&first=1"
-    srch2 = "https://www.bing.com/search?q=" + qstr + "&rdr=1&first=2"
-    srch3 = "https://www.bing.com/search?q=" + qstr + "&rdr=1&first=3"
-
-    webs = []
-    srchs = [ srch1 ]
-    if numresults > 20:
-        srchs = [srch1, srch2, srch3]
-    elif numresults > 10:
-        srchs = [srch1, srch2]
+    numpages = max(1, (numresults + 9) // 10)
+    srchs = ["https://www.bing.com/search?q=" + qstr + "&rdr=1&first=" + str(pageno * 10 + 1) for pageno in range(numpages)]
 
     log(f" run Bing search ...  {searchphrase}" + (" " * 20), endstr="\r")
-    results = getAsyncWebResponses(srchs)
+    results = getAsyncWebResponses(srchs, render=False)
+    webs = []
     for aresult in results:
-        contents = aresult.html.html
+        if aresult == None:
+            continue
         try:
             log(" parse Bing search results..." + (" " * 40), endstr="\r")
-            # carefully skip Ads and other non-essential materials
-            for b_algo in BeautifulSoup(contents, 'html.parser').find("div", id="b_content").find_all("li", class_="b_algo"):
-                s1 = BeautifulSoup(str(b_algo), 'html.parser')
-                a_tags = s1.find_all('a')
-                #  find first <a> tag with href and starts with https://, skip positional or javascript <a> tag
-                for a_tag in a_tags:
-                    bhref = a_tag.get("href")
-                    if bhref != None and  bhref.lower().startswith('https://'):
-                        log(f'  a valid search result url {bhref[:60]}        ', endstr='\r')
-                        webs.append(str(bhref))
-                        break
-
+            for aweb in parseBingResults(aresult.text):
+                if aweb not in webs:
+                    webs.append(aweb)
         except Exception as err:
             log(f"Unexpected {err=} when parsing Bing result", endstr="\n", outfile=sys.stdout)
             traceback.print_exc(limit=8, file=sys.stderr, chain=False)
-    return webs[:numresults]
\ No newline at end of file
+    return webs[:numresults]
+
+def fixtureSearchProvider(fixturedir):
+    """
+    Make a search link provider from local fixtures, for tests and offline runs.
+    For a search phrase, <fixturedir>/<canonicalized phrase>.json (a list of URLs) is used,
+    or <fixturedir>/<canonicalized phrase>.html (a saved Bing search result page) is parsed.
+
+    :param fixturedir:  the directory of fixture files
+    :return:  a search link provider function (searchphrase, numresults) -> a list of URLs
+    """
+    def fixtureSearchLinks(searchphrase, numresults=10):
+        fixturename = os.path.join(fixturedir, canonicalize(searchphrase))
+        if os.path.isfile(fixturename + ".json"):
+            with open(fixturename + ".json") as fixturefile:
+                return json.load(fixturefile)[:numresults]
+        if os.path.isfile(fixturename + ".html"):
+            with open(fixturename + ".html") as fixturefile:
+                return parseBingResults(fixturefile.read())[:numresults]
+        log(f"No search fixture for {searchphrase=} in {fixturedir}      ", endstr="\n")
+        return []
+    # fixture results are not cached, runs with fixtures do not depend on each other
+    fixtureSearchLinks.cachename = ""
+    return fixtureSearchLinks
+
+def searchCacheName(provider):
+    """
+    :param provider:   a search link provider
+    :return:  cache name of the provider: its cachename attribute, or its function name.
+              empty for providers without a stable name (lambda, functools.partial), which are not cached
+    """
+    cachename = getattr(provider, "cachename", None)
+    if cachename == None:
+        cachename = getattr(provider, "__name__", "")
+    return cachename if cachename.isidentifier() else ""
+
+def getSearchLinks(searchphrase, numresults=10, provider=bingSearchLinks, ttl=search_cache_ttl, cachename=None):
+    """
+    Get a list of URLs for a search phrase from a search link provider.
+    Results are cached in /tmp by provider and canonicalized search phrase, and reused until ttl expires.
+
+    :param searchphrase:  the search query
+    :param numresults:   the number of URLs returned
+    :param provider:     a function (searchphrase, numresults) -> a list of URLs, default Bing
+    :param ttl:          cache expiry, in seconds. 0 to skip cache
+    :param cachename:    cache name of the provider, default from searchCacheName. empty to skip cache
+    :return:  a list of URLs in string format
+    """
+    if cachename == None:
+        cachename = searchCacheName(provider)
+    if len(cachename) == 0:
+        ttl = 0
+    cachefilename = "/tmp/search-" + cachename + "-" + getFilenameHash(None, searchphrase) + ".json"
+    if ttl > 0 and os.path.isfile(cachefilename):
+        try:
+            with open(cachefilename) as cachefile:
+                cached = json.load(cachefile)
+            if time.time() - cached["time"] < ttl and (cached["numresults"] >= numresults or len(cached["links"]) < cached["numresults"]):
+                log(f"Using cached search links for {searchphrase}" + (" " * 20), endstr="\n")
+                return cached["links"][:numresults]
+        except Exception as err:
+            log(f"Ignore broken search cache {cachefilename} -- {err=}", endstr="\n", outfile=sys.stderr)
+
+    webs = provider(searchphrase, numresults)
+    if ttl > 0 and len(webs) > 0:
+        with open(cachefilename, "w") as cachefile:
+            json.dump({"time": time.time(), "numresults": numresults, "links": webs}, cachefile)
+    return webs
+
+def getBingSearchLinks(searchphrase, numresults=10):
+    """
+    Search BING with a search phrase, return a list of URLs.
+    Ignore ads, and other URLs, just the main page URLs from Bing algorithm
+
+    :param searchphrase:  the search query to Bing
+    :param numresults:   the number of URLs returned, default 10 - first Bing page
+    :return:  a list of URLs in string format
+    """
+    return getSearchLinks(searchphrase, numresults, provider=bingSearchLinks)